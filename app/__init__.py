@@ -25,25 +25,49 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
     
+    # orjson for JSON responses (falls back to Flask's json if not installed)
+    from app.utils.json_provider import init_json_provider
+    init_json_provider(app)
+    
     # Initialize extensions with app
     db.init_app(app)
     
     # Configure SQLite for better concurrency handling
     if app.config.get('SQLALCHEMY_DATABASE_URI', '').startswith('sqlite'):
         from sqlalchemy import event
-        from sqlalchemy.engine import Engine
         
-        @event.listens_for(Engine, "connect")
+        # ✅ Слушатели вешаем на движок этого приложения, а не на глобальный класс Engine:
+        # ✅ иначе каждый create_app() добавляет еще один BEGIN на каждое соединение
+        with app.app_context():
+            engine = db.engine
+        
+        @event.listens_for(engine, "connect")
         def set_sqlite_pragma(dbapi_conn, connection_record):
             """Set SQLite pragmas for better concurrency"""
             cursor = dbapi_conn.cursor()
             # Enable WAL mode for better concurrency (allows multiple readers)
             cursor.execute("PRAGMA journal_mode=WAL")
+            # WAL is durable across crashes with NORMAL sync; fsync only at checkpoints
+            cursor.execute("PRAGMA synchronous=NORMAL")
             # Increase timeout for database locks (default is 5 seconds)
+            # SQLite waits on the lock in C instead of bouncing SQLITE_BUSY back to Python retry loops
             cursor.execute("PRAGMA busy_timeout=10000")  # 10 seconds
+            # Keep temp tables/indices in memory and use a 64MB page cache
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.execute("PRAGMA cache_size=-64000")
             # Enable foreign keys
             cursor.execute("PRAGMA foreign_keys=ON")
             cursor.close()
+            # Let SQLAlchemy emit BEGIN itself (see do_sqlite_begin)
+            dbapi_conn.isolation_level = None
+        
+        @event.listens_for(engine, "begin")
+        def do_sqlite_begin(conn):
+            """Emit BEGIN, or BEGIN IMMEDIATE for write transactions (see sqlite_write_tx)"""
+            if conn.get_execution_options().get('sqlite_begin_immediate'):
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            else:
+                conn.exec_driver_sql("BEGIN")
     
     migrate.init_app(app, db)
     login_manager.init_app(app)
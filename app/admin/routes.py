@@ -20,6 +20,7 @@ except ImportError:
     warnings.warn("defusedxml not installed - XXE protection disabled", UserWarning)
 from datetime import datetime, timedelta
 from app.utils.datetime_utils import moscow_now_naive
+from app.utils.video_types import get_video_types_dict
 
 @bp.route('/dashboard')
 @login_required
@@ -681,8 +682,7 @@ def orders():
     )
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     return render_template(
         'admin/orders.html',
@@ -703,8 +703,7 @@ def order_detail(order_id):
     order = Order.query.get_or_404(order_id)
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     status_options = [
         meta for meta in get_status_filter_choices(include_cancelled_group=False)
@@ -14,6 +14,9 @@ from app.utils.email import send_chat_notification_email
 
 bp = Blueprint('chat_api', __name__, url_prefix='/chat')
 
+# Роли, которым доступны чаты всех заказов
+FULL_CHAT_ACCESS_ROLES = frozenset({'ADMIN', 'MOM'})
+
 @bp.route('/order/<int:order_id>/messages', methods=['GET'])
 @login_required
 @role_required('OPERATOR', 'MOM', 'ADMIN')
@@ -68,13 +71,14 @@ def get_chat_messages(order_id):
 def send_chat_message(order_id):
     """Send a message to order chat"""
     try:
-        current_app.logger.info(f"Chat message send attempt: order_id={order_id}, user_id={current_user.id}, user_role={current_user.role}")
+        user = current_user._get_current_object()
+        current_app.logger.info(f"Chat message send attempt: order_id={order_id}, user_id={user.id}, user_role={user.role}")
         
         order = Order.query.get_or_404(order_id)
         
         # Check access rights
-        if not _has_chat_access(order, current_user):
-            current_app.logger.warning(f"Chat access denied: order_id={order_id}, user_id={current_user.id}")
+        if not _has_chat_access(order, user):
+            current_app.logger.warning(f"Chat access denied: order_id={order_id}, user_id={user.id}")
             return jsonify({'error': 'Нет доступа к чату этого заказа'}), 403
         
         # Get or create chat
@@ -146,7 +150,7 @@ def send_chat_message(order_id):
         try:
             message = ChatMessage(
                 chat_id=chat.id,
-                sender_id=current_user.id,
+                sender_id=user.id,
                 message=message_text,
                 attachment_path=attachment_path,
                 attachment_name=attachment_name
@@ -177,7 +181,7 @@ def send_chat_message(order_id):
         
         # Send notifications to other participants
         try:
-            _send_chat_notifications(chat, message, current_user)
+            _send_chat_notifications(chat, message, user)
         except Exception as e:
             current_app.logger.error(f"Failed to send chat notifications: {e}", exc_info=True)
         
@@ -185,8 +189,8 @@ def send_chat_message(order_id):
             'success': True,
             'message': {
                 'id': message.id,
-                'sender_name': current_user.full_name,
-                'sender_role': current_user.role,
+                'sender_name': user.full_name,
+                'sender_role': user.role,
                 'message': message.message,
                 'message_type': message.message_type,
                 'created_at': message.created_at.isoformat(),
@@ -237,16 +241,14 @@ def mark_messages_read(order_id):
 
 def _has_chat_access(order, user):
     """Check if user has access to order chat"""
-    # Admin has access to all chats
-    if user.role == 'ADMIN':
-        return True
+    role = user.role
     
-    # MOM has access to all chats
-    if user.role == 'MOM':
+    # Admin and MOM have access to all chats
+    if role in FULL_CHAT_ACCESS_ROLES:
         return True
     
     # Operator has access only to assigned orders
-    if user.role == 'OPERATOR':
+    if role == 'OPERATOR':
         return order.operator_id == user.id or order.operator_id is None
     
     return False
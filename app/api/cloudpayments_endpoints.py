@@ -5,8 +5,9 @@ Handles webhook notifications from CloudPayments
 
 from flask import request, jsonify, current_app
 from app import db
-from app.models import Order, Payment, User, AuditLog
-from app.utils.cloudpayments import CloudPaymentsAPI
+from app.models import Order, Payment, User
+from app.tasks.audit import enqueue_audit_log
+from app.utils.cloudpayments import get_cloudpayments_api
 from app.utils.datetime_utils import moscow_now_naive
 from sqlalchemy.exc import IntegrityError
 import logging
@@ -41,7 +42,7 @@ def register_cloudpayments_routes(bp):
             )
             
             # Verify signature
-            cp_api = CloudPaymentsAPI()
+            cp_api = get_cloudpayments_api()
             signature_valid = cp_api.verify_webhook_signature(raw_data, signature)
             
             if not signature_valid:
@@ -268,8 +269,8 @@ def handle_pay_notification(data):
             logger.warning(f'Duplicate payment {transaction_id} detected (IntegrityError): {str(e)}')
             return jsonify({'code': 0, 'message': 'Already processed'}), 200
         
-        # Логирование после успешного коммита
-        AuditLog.create_log(
+        # Логирование после успешного коммита (в фоне, ответ CloudPayments не ждет записи)
+        enqueue_audit_log(
             user_id=None,  # System action
             action='PAYMENT_AUTHORIZED',
             resource_type='Order',
@@ -282,8 +283,7 @@ def handle_pay_notification(data):
                 'payment_method': payment_method
             },
             ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent'),
-            commit=True  # ✅ Коммитим отдельно, т.к. основная транзакция уже завершена
+            user_agent=request.headers.get('User-Agent')
         )
         
         # Send payment success email to customer
@@ -322,7 +322,7 @@ def handle_fail_notification(data):
         order = Order.query.filter_by(order_number=invoice_id).first()
         if order:
             # Log failed payment attempt
-            AuditLog.create_log(
+            enqueue_audit_log(
                 user_id=None,
                 action='PAYMENT_FAILED',
                 resource_type='Order',
@@ -370,7 +370,7 @@ def handle_confirm_notification(data):
             db.session.commit()
             
             # Log confirmation
-            AuditLog.create_log(
+            enqueue_audit_log(
                 user_id=None,
                 action='PAYMENT_CONFIRMED',
                 resource_type='Payment',
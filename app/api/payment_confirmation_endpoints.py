@@ -1,7 +1,8 @@
 from flask import request, jsonify, current_app
 from flask_login import login_required, current_user
 from app import db
-from app.models import Order, Payment, AuditLog
+from app.models import Order, Payment
+from app.tasks.audit import enqueue_audit_log
 from app.utils.decorators import role_required
 from app.utils.email import send_email
 from app.utils.datetime_utils import moscow_now_naive
@@ -65,7 +66,7 @@ def register_payment_confirmation_routes(bp):
             db.session.commit()
             
             # Log action
-            AuditLog.create_log(
+            enqueue_audit_log(
                 user_id=current_user.id,
                 action='PAYMENT_CONFIRMED',
                 resource_type='Order',
@@ -167,7 +168,7 @@ def register_payment_confirmation_routes(bp):
             db.session.commit()
             
             # Log action
-            AuditLog.create_log(
+            enqueue_audit_log(
                 user_id=current_user.id,
                 action='PAYMENT_REFUND',
                 resource_type='Order',
@@ -1,7 +1,8 @@
 from flask import request, jsonify
 from flask_login import login_required, current_user
 from app import db
-from app.models import Order, Payment, AuditLog
+from app.models import Order, Payment
+from app.tasks.audit import enqueue_audit_log
 from app.utils.decorators import admin_or_mom_required
 from app.utils.datetime_utils import moscow_now_naive
 import logging
@@ -100,7 +101,7 @@ def register_refund_routes(bp):
             db.session.commit()
             
             # Log action
-            AuditLog.create_log(
+            enqueue_audit_log(
                 user_id=current_user.id,
                 action='ORDER_REFUND',
                 resource_type='Order',
@@ -1,49 +1,130 @@
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, abort, session, url_for
 from flask_login import login_required, current_user
 from app import db
 from app.api import bp
 from app.api.cloudpayments_endpoints import register_cloudpayments_routes
-from app.models import Order, Payment, User, AuditLog, VideoType
-from app.utils.decorators import admin_or_mom_required, role_required
-from app.utils.cloudpayments import CloudPaymentsAPI
+from app.models import (
+    Athlete, AuditLog, Category, Event, Order, Payment, User, VideoType,
+)
+from app.utils.decorators import STAFF_ROLES, admin_or_mom_required, role_required
+from app.utils.cloudpayments import get_cloudpayments_api
 from app.utils.email import send_order_confirmation_email
+from app.tasks.notifications import (
+    enqueue_notification,
+    post_status_change_message_task,
+    send_order_cancellation_task,
+    send_video_links_task,
+)
+from app.tasks.payments import PAYMENT_RESULT_TIMEOUT, enqueue_charge
 from app.utils.datetime_utils import moscow_now_naive
+from app.utils.video_types import get_video_type_payloads
+from app.utils.db_retry import sqlite_retry, sqlite_write_tx
+from app.utils.order_chat import stage_status_change_message
 from app.utils.order_status import (
     ALL_ORDER_STATUSES,
     is_valid_status_transition,
 )
 import copy
 import logging
-import base64
-import requests
-import random
+from itertools import repeat
+import re
 import time
 from urllib.parse import urlparse
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+# Optional email_validator import
+try:
+    from email_validator import validate_email, EmailNotValidError
+    EMAIL_VALIDATOR_AVAILABLE = True
+except ImportError:
+    EMAIL_VALIDATOR_AVAILABLE = False
+    validate_email = None
+    EmailNotValidError = ValueError
 
 logger = logging.getLogger(__name__)
-def _execute_db_operation_with_retry(operation_fn, context: str):
-    """Execute a DB write operation with retry logic for sqlite 'database is locked' errors."""
-    max_retries = 5
-    retry_delay = 0.1
 
-    for attempt in range(max_retries):
-        try:
-            operation_fn()
-            db.session.commit()
-            return
-        except OperationalError as exc:
-            db.session.rollback()
-            if 'database is locked' in str(exc).lower() and attempt < max_retries - 1:
-                wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                logger.warning(
-                    f"Database locked while executing '{context}'. "
-                    f"Retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})"
-                )
-                time.sleep(wait_time)
-            else:
-                logger.error(f"DB operation '{context}' failed after {attempt + 1} attempts: {exc}")
-                raise
+# Простая проверка email, если email_validator не установлен (компилируется один раз)
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+
+def _rollback_if_pending():
+    """
+    Roll back only if the session holds pending ORM changes
+    
+    For read-only handlers: a clean session needs no ROLLBACK round-trip, the request
+    teardown releases the connection anyway.
+    """
+    session = db.session
+    if session.new or session.dirty or session.deleted:
+        session.rollback()
+
+
+def _get_order_or_404(order_id, *options):
+    """Load an order by primary key via Session.get (identity map first), aborting with 404 if missing"""
+    order = db.session.get(Order, order_id, options=list(options) or None)
+    if order is None:
+        abort(404)
+    return order
+
+
+@sqlite_retry()
+def _transition_order(order_id, expected_status, expected_paid_amount, new_status, new_paid_amount,
+                      changed_at):
+    """
+    Move the order to a new status/paid_amount with one conditional UPDATE and commit it
+    
+    UPDATE ... WHERE id = ? AND status = ? AND paid_amount = ?: of two concurrent requests
+    only one changes the row, also on SQLite where FOR UPDATE is not rendered.
+    
+    Returns:
+        True if this call changed the order, False if it no longer matches the expected values
+    """
+    with sqlite_write_tx():
+        result = db.session.execute(
+            update(Order)
+            .where(
+                Order.id == order_id,
+                Order.status == expected_status,
+                Order.paid_amount == expected_paid_amount
+            )
+            .values(status=new_status, paid_amount=new_paid_amount, updated_at=changed_at)
+            .execution_options(synchronize_session=False)
+        )
+    return result.rowcount == 1
+
+
+def _find_order_payments(order_id, *statuses):
+    """
+    Get the order's payments with the given statuses in one query (index on payments(order_id, status))
+    
+    Returns:
+        dict status -> first payment with that status (by id); missing statuses are absent
+    """
+    payments_by_status = {}
+    for payment in db.session.scalars(
+        select(Payment)
+        .where(Payment.order_id == order_id, Payment.status.in_(statuses))
+        .order_by(Payment.id)
+    ):
+        payments_by_status.setdefault(payment.status, payment)
+    return payments_by_status
+
+
+def _parse_cart_key(item_id):
+    """
+    Parse a cart key '<athlete_id>_<video_type_id>' without raising
+    
+    Returns:
+        (athlete_id, video_type_id) or None if the key is malformed
+    """
+    if not isinstance(item_id, str):
+        return None
+    athlete_part, sep, video_type_part = item_id.partition('_')
+    if not sep or not athlete_part.isdecimal() or not video_type_part.isdecimal():
+        return None
+    return int(athlete_part), int(video_type_part)
 
 
 def _mask_internal_error(exc: Exception, fallback_message: str) -> str:
@@ -53,6 +134,32 @@ def _mask_internal_error(exc: Exception, fallback_message: str) -> str:
     return fallback_message
 
 
+def _internal_error_response(exc: Exception, log_message: str, fallback_message: str, exc_info=False):
+    """
+    Log an unexpected handler error and build the masked 500 response
+    
+    Only a database error leaves the session in a state that needs an explicit ROLLBACK;
+    for anything else the session is rolled back only if it holds pending changes.
+    """
+    logger.error('%s: %s', log_message, exc, exc_info=exc_info)
+    if isinstance(exc, SQLAlchemyError):
+        db.session.rollback()
+    else:
+        _rollback_if_pending()
+    return jsonify({'success': False, 'error': _mask_internal_error(exc, fallback_message)}), 500
+
+
+def _json_body() -> dict:
+    """
+    JSON object from the request body, {} if it is missing or not an object
+    
+    Malformed input then fails the handler's own field validation with a 400
+    instead of raising inside the try block and ending up as a 500.
+    """
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
 def _validate_video_links(video_links: dict) -> tuple:
     """
     Validate video links - check that all links are valid URLs.
@@ -74,7 +181,32 @@ def _validate_video_links(video_links: dict) -> tuple:
     
     return True, ''
 
-OPERATOR_MANAGEABLE_STATUSES = (
+
+def _flatten_video_type_ids(items):
+    """Yield video type ids from Order.video_types, skipping empty values and unwrapping nested lists / {'id': ...} dicts"""
+    for item in items:
+        if item is None or item == [] or item == {}:
+            continue
+        if isinstance(item, list):
+            yield from _flatten_video_type_ids(item)
+        elif isinstance(item, dict):
+            if item.get('id') is not None:
+                yield item['id']
+        else:
+            yield item
+
+
+def _to_video_type_id(value):
+    """Normalize a video type id from JSON (int or numeric string) to int; None if invalid"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# Status sets for validation (frozenset: one hash probe per check, shared by all handlers)
+VALID_ORDER_STATUSES = frozenset(ALL_ORDER_STATUSES)
+
+OPERATOR_MANAGEABLE_STATUSES = frozenset({
     'processing',
     'awaiting_info',
     'ready',
@@ -84,7 +216,37 @@ OPERATOR_MANAGEABLE_STATUSES = (
     'refund_required',
     'cancelled_unpaid',
     'cancelled_manual',
-)
+})
+
+# Statuses that close the order (processed_at is set)
+FINALIZED_STATUSES = frozenset({
+    'completed',
+    'completed_partial_refund',
+    'cancelled_unpaid',
+    'cancelled_manual',
+    'refunded_full',
+    'refunded_partial',
+})
+
+CANCELLED_STATUSES = frozenset({'cancelled_unpaid', 'cancelled_manual'})
+
+
+def _apply_status(order, new_status, comment):
+    """
+    Apply a manual status change to the order (shared by admin/mom and operator handlers)
+    
+    Only mutates the order; the caller commits and, for cancellations, queues the email after commit.
+    """
+    order.status = new_status
+    if comment:
+        order.operator_comment = comment
+    
+    if new_status in FINALIZED_STATUSES:
+        order.processed_at = moscow_now_naive()
+    
+    # Если заказ отменяется, сохраняем причину
+    if new_status in CANCELLED_STATUSES:
+        order.cancellation_reason = comment
 
 # DEPRECATED: Use /cloudpayments/webhook instead
 # This route is kept for backward compatibility but may be removed
@@ -116,14 +278,14 @@ OPERATOR_MANAGEABLE_STATUSES = (
 def create_payment():
     """Create payment intent for order (CloudPayments widget data)"""
     try:
-        data = request.get_json()
+        data = _json_body()
         order_id = data.get('order_id')
         payment_method = data.get('payment_method', 'card')
         
         if not order_id:
             return jsonify({'success': False, 'error': 'Order ID required'}), 400
         
-        order = Order.query.get_or_404(order_id)
+        order = _get_order_or_404(order_id)
         
         # Check if order is in correct status
         if order.status != 'checkout_initiated':
@@ -131,7 +293,7 @@ def create_payment():
         
         # Generate CloudPayments widget data
         try:
-            cp_api = CloudPaymentsAPI()
+            cp_api = get_cloudpayments_api()
             payment_data = cp_api.create_payment_widget_data(order, payment_method)
             
             if not payment_data:
@@ -156,17 +318,16 @@ def create_payment():
                 'error': f'Ошибка CloudPayments: {str(cp_error)}'
             }), 500
         
+        @sqlite_retry()
         def _set_awaiting_payment_status():
-            fresh_order = Order.query.get(order.id)
-            if not fresh_order:
-                raise ValueError('Order not found during status update')
-            fresh_order.status = 'awaiting_payment'
-            fresh_order.payment_method = payment_method
-
-        _execute_db_operation_with_retry(
-            _set_awaiting_payment_status,
-            'api.create_payment.awaiting_payment'
-        )
+            with sqlite_write_tx():
+                fresh_order = db.session.get(Order, order.id)
+                if not fresh_order:
+                    raise ValueError('Order not found during status update')
+                fresh_order.status = 'awaiting_payment'
+                fresh_order.payment_method = payment_method
+
+        _set_awaiting_payment_status()
         
         return jsonify({
             'success': True,
@@ -174,15 +335,17 @@ def create_payment():
         })
         
     except Exception as e:
-        logger.error(f'Create payment error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Не удалось создать платеж')}), 500
+        return _internal_error_response(e, 'Create payment error', 'Не удалось создать платеж')
 
 @bp.route('/payment/process', methods=['POST'])
 def process_payment():
-    """Process payment with cryptogram from CloudPayments Checkout"""
+    """
+    Accept a cryptogram from CloudPayments Checkout and charge it in the background
+    
+    Returns 202 right away; the result is polled via process_payment_status.
+    """
     try:
-        data = request.get_json()
+        data = _json_body()
         cryptogram = data.get('cryptogram')
         amount = data.get('amount')
         currency = data.get('currency')
@@ -196,10 +359,7 @@ def process_payment():
             return jsonify({'success': False, 'error': 'Missing required payment data'}), 400
         
         # Get order
-        order = Order.query.get_or_404(order_id)
-        
-        # Process payment with CloudPayments API
-        cp_api = CloudPaymentsAPI()
+        order = _get_order_or_404(order_id)
         
         # Prepare payment data for API
         payment_data = {
@@ -213,85 +373,70 @@ def process_payment():
             'Name': f"{order.contact_first_name} {order.contact_last_name}".strip() or 'Cardholder'
         }
         
-        # Send payment to CloudPayments API
-        auth_string = f"{cp_api.public_id}:{cp_api.api_secret}"
-        auth_token = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+        # ✅ Последний платеж до списания: статус считается по платежам, появившимся после него
+        last_payment_id = db.session.execute(
+            select(func.max(Payment.id)).where(Payment.order_id == order.id)
+        ).scalar() or 0
         
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Basic {auth_token}'
-        }
+        # ✅ Списание (запрос к CloudPayments до 30 секунд) выполняет фоновый воркер
+        if not enqueue_charge(order.id, payment_data, payment_method):
+            return jsonify({
+                'success': False,
+                'error': 'Платежный сервис перегружен. Попробуйте еще раз через несколько секунд.'
+            }), 503
         
-        response = requests.post(
-            f"{cp_api.base_url}/payments/cards/charge",
-            headers=headers,
-            json=payment_data,
-            timeout=30
-        )
+        return jsonify({
+            'success': True,
+            'transaction_pending': True,
+            'order_id': order.id,
+            'status_url': url_for('api.process_payment_status', order_id=order.id, after=last_payment_id,
+                                  started=int(time.time()))
+        }), 202
         
-        if response.status_code == 200:
-            result = response.json()
-            
-            if result.get('Success'):
-                # Payment successful
-                transaction_id = result.get('TransactionId')
-                
-                payment_payload = {
-                    'order_id': order.id,
-                    'cp_transaction_id': transaction_id,
-                    'amount': float(amount),
-                    'currency': currency,
-                    'status': 'authorized',
-                    'method': payment_method,
-                    'email': email,
-                    'raw_payload': result
-                }
+    except Exception as e:
+        return _internal_error_response(e, 'Process payment error', 'Не удалось обработать платеж')
 
-                def _persist_payment_and_update_order():
-                    fresh_order = Order.query.get(order.id)
-                    if not fresh_order:
-                        raise ValueError('Order not found during payment persistence')
-                    payment_record = Payment(**payment_payload)
-                    db.session.add(payment_record)
-                    fresh_order.status = 'paid'
-                    fresh_order.paid_amount = float(amount)
-                    fresh_order.payment_intent_id = transaction_id
-                    fresh_order.payment_method = payment_method
-
-                _execute_db_operation_with_retry(
-                    _persist_payment_and_update_order,
-                    'api.process_payment.persist'
-                )
-                
-                logger.info(f'Payment successful for order {order.order_number}, transaction {transaction_id}')
-                
-                return jsonify({
-                    'success': True,
-                    'transaction_id': transaction_id,
-                    'message': 'Payment processed successfully'
-                })
-            else:
-                # Payment failed
-                error_message = result.get('Message', 'Unknown error')
-                logger.error(f'Payment failed for order {order.order_number}: {error_message}')
-                
-                return jsonify({
-                    'success': False,
-                    'error': error_message
-                }), 400
-        else:
-            # HTTP error
-            logger.error(f'Payment API error: {response.status_code} - {response.text}')
-            
+@bp.route('/payment/process/<int:order_id>/status', methods=['GET'])
+def process_payment_status(order_id):
+    """Poll the result of a background charge started by process_payment"""
+    order = db.session.get(Order, order_id) or abort(404)
+    
+    # ✅ Статус видит владелец заказа (или текущая сессия оформления) и персонал
+    user = current_user._get_current_object()
+    is_owner = user.is_authenticated and order.customer_id == user.id
+    is_staff = user.is_authenticated and user.role in STAFF_ROLES
+    if not (is_owner or is_staff or session.get('pending_order_id') == order.id):
+        return jsonify({'success': False, 'error': 'Доступ запрещен'}), 403
+    
+    after_id = request.args.get('after', 0, type=int)
+    payment = db.session.execute(
+        select(Payment)
+        .where(Payment.order_id == order.id, Payment.id > after_id)
+        .order_by(Payment.id.desc())
+        .limit(1)
+    ).scalar()
+    
+    if payment is None:
+        # ✅ Очередь списаний живет в памяти процесса: после рестарта задачи нет, и результат уже не появится
+        started = request.args.get('started', type=int)
+        if started and time.time() - started > PAYMENT_RESULT_TIMEOUT:
             return jsonify({
                 'success': False,
-                'error': f'Payment API error: {response.status_code}'
-            }), 500
-        
-    except Exception as e:
-        logger.error(f'Process payment error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Не удалось обработать платеж')}), 500
+                'status': 'unknown',
+                'error': 'Не удалось получить результат платежа. Проверьте статус заказа или обратитесь в поддержку.'
+            })
+        return jsonify({'success': True, 'status': 'pending'})
+    
+    if payment.status == 'failed':
+        error_message = (payment.raw_payload or {}).get('Message', 'Unknown error')
+        return jsonify({'success': False, 'status': 'failed', 'error': error_message})
+    
+    return jsonify({
+        'success': True,
+        'status': 'paid',
+        'transaction_id': payment.cp_transaction_id,
+        'message': 'Payment processed successfully'
+    })
 
 @bp.route('/order/<int:order_id>/change-status', methods=['POST'])
 @login_required
@@ -299,13 +444,9 @@ def process_payment():
 def change_order_status(order_id):
     """Change order status"""
     try:
-        import time
-        import random
-        from sqlalchemy.exc import OperationalError
+        order = _get_order_or_404(order_id)
         
-        order = Order.query.get_or_404(order_id)
-        
-        data = request.get_json()
+        data = _json_body()
         new_status = data.get('status')
         operator_comment = data.get('comment', '')
         
@@ -322,64 +463,35 @@ def change_order_status(order_id):
                 'error': f'Невозможен переход из статуса {order.status} в {new_status}'
             }), 400
         
-        # Update order - save old status before changing
         old_status = order.status
-        order.status = new_status
-        if operator_comment:
-            order.operator_comment = operator_comment
-        
-        if new_status in ['completed', 'completed_partial_refund', 'cancelled_manual']:
-            order.processed_at = moscow_now_naive()
-        
-        # Если заказ отменяется, сохраняем причину
-        if new_status == 'cancelled_manual':
-            order.cancellation_reason = operator_comment
-        
-        # ✅ Retry логика для обработки "database is locked"
-        max_retries = 5
-        retry_delay = 0.1  # Start with 100ms
+        user_id = current_user.id
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        
+        # ✅ Изменение заказа и запись аудита - одна транзакция (один COMMIT)
+        # ✅ Retry логика для обработки "database is locked" (изменения применяются заново после rollback)
+        @sqlite_retry()
+        def _apply_status_change():
+            with sqlite_write_tx():
+                _apply_status(order, new_status, operator_comment)
+                
+                # Log action
+                AuditLog.create_log(
+                    user_id=user_id,
+                    action='ORDER_STATUS_CHANGE',
+                    resource_type='Order',
+                    resource_id=str(order_id),
+                    details={'old_status': old_status, 'new_status': new_status, 'comment': operator_comment},
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    bulk=True
+                )
         
-        for attempt in range(max_retries):
-            try:
-                db.session.commit()
-                break  # Success, exit retry loop
-            except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
-                    db.session.rollback()
-                    wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                    logger.warning(f'Database locked in change_order_status, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
-                    time.sleep(wait_time)
-                    # Re-apply changes after rollback
-                    order.status = new_status
-                    if operator_comment:
-                        order.operator_comment = operator_comment
-                    if new_status in ['completed', 'completed_partial_refund', 'cancelled_manual']:
-                        order.processed_at = moscow_now_naive()
-                    if new_status == 'cancelled_manual':
-                        order.cancellation_reason = operator_comment
-                else:
-                    db.session.rollback()
-                    logger.error(f'Error changing order status after {attempt + 1} attempts: {str(e)}')
-                    raise
+        _apply_status_change()
         
-        # ✅ Отправляем email ПОСЛЕ коммита (не блокирует транзакцию)
-        if new_status == 'cancelled_manual':
-            try:
-                from app.utils.email import send_order_cancellation_email
-                send_order_cancellation_email(order, operator_comment)
-            except Exception as e:
-                logger.error(f"Error sending cancellation email: {e}")
-        
-        # Log action
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='ORDER_STATUS_CHANGE',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={'old_status': old_status, 'new_status': new_status, 'comment': operator_comment},
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+        # ✅ Email об отмене отправляет фоновый воркер ПОСЛЕ коммита (SMTP не держит запрос)
+        if new_status in CANCELLED_STATUSES:
+            enqueue_notification(send_order_cancellation_task, order_id, operator_comment)
         
         return jsonify({
             'success': True,
@@ -392,12 +504,7 @@ def change_order_status(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Change order status error: {str(e)}')
-        db.session.rollback()
-        return jsonify({
-            'success': False,
-            'error': _mask_internal_error(e, 'Не удалось изменить статус заказа')
-        }), 500
+        return _internal_error_response(e, 'Change order status error', 'Не удалось изменить статус заказа')
 
 @bp.route('/order/<int:order_id>/operator-change-status', methods=['POST'])
 @login_required
@@ -405,13 +512,9 @@ def change_order_status(order_id):
 def operator_change_order_status(order_id):
     """Change order status by operator"""
     try:
-        import time
-        import random
-        from sqlalchemy.exc import OperationalError
-        
-        order = Order.query.get_or_404(order_id)
+        order = _get_order_or_404(order_id)
         
-        data = request.get_json()
+        data = _json_body()
         new_status = data.get('status')
         operator_comment = data.get('comment', '')
         
@@ -419,7 +522,7 @@ def operator_change_order_status(order_id):
             return jsonify({'success': False, 'error': 'Status required'}), 400
         
         # Validate status
-        if new_status not in ALL_ORDER_STATUSES:
+        if new_status not in VALID_ORDER_STATUSES:
             return jsonify({'success': False, 'error': 'Invalid status'}), 400
         
         if not is_valid_status_transition(order.status, new_status):
@@ -428,83 +531,48 @@ def operator_change_order_status(order_id):
                 'error': f'Невозможен переход из статуса {order.status} в {new_status}'
             }), 400
         
-        if order.operator_id and order.operator_id != current_user.id:
+        user_id = current_user.id
+        if order.operator_id and order.operator_id != user_id:
             return jsonify({
                 'success': False,
                 'error': 'Заказ закреплен за другим оператором'
             }), 403
         
-        # Update order - save old status before changing
         old_status = order.status
-        order.status = new_status
-        if operator_comment:
-            order.operator_comment = operator_comment
-        
-        # Set operator if not set
-        if not order.operator_id:
-            order.operator_id = current_user.id
-        
-        if new_status in ['completed', 'completed_partial_refund', 'cancelled_unpaid', 'cancelled_manual', 'refunded_full', 'refunded_partial']:
-            order.processed_at = moscow_now_naive()
-        
-        # Если заказ отменяется, сохраняем причину
-        if new_status in ['cancelled_unpaid', 'cancelled_manual']:
-            order.cancellation_reason = operator_comment
-        
-        # ✅ Retry логика для обработки "database is locked"
-        max_retries = 5
-        retry_delay = 0.1  # Start with 100ms
-        
-        for attempt in range(max_retries):
-            try:
-                db.session.commit()
-                break  # Success, exit retry loop
-            except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
-                    db.session.rollback()
-                    wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                    logger.warning(f'Database locked in operator_change_order_status, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
-                    time.sleep(wait_time)
-                    # Re-apply changes after rollback
-                    order.status = new_status
-                    if operator_comment:
-                        order.operator_comment = operator_comment
-                    if not order.operator_id:
-                        order.operator_id = current_user.id
-                    if new_status in ['completed', 'completed_partial_refund', 'cancelled_unpaid', 'cancelled_manual', 'refunded_full', 'refunded_partial']:
-                        order.processed_at = moscow_now_naive()
-                    if new_status in ['cancelled_unpaid', 'cancelled_manual']:
-                        order.cancellation_reason = operator_comment
-                else:
-                    db.session.rollback()
-                    logger.error(f'Error changing order status by operator after {attempt + 1} attempts: {str(e)}')
-                    raise
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        
+        # ✅ Изменение заказа, системное сообщение в чат и аудит - одна транзакция (один COMMIT)
+        # ✅ Retry логика для обработки "database is locked" (изменения применяются заново после rollback)
+        @sqlite_retry()
+        def _apply_status_change():
+            with sqlite_write_tx():
+                _apply_status(order, new_status, operator_comment)
+                
+                # Set operator if not set
+                if not order.operator_id:
+                    order.operator_id = user_id
+                
+                # Add system message to chat
+                stage_status_change_message(order_id, new_status, operator_comment, user_id)
+                
+                # Log action
+                AuditLog.create_log(
+                    user_id=user_id,
+                    action='ORDER_STATUS_CHANGE',
+                    resource_type='Order',
+                    resource_id=str(order_id),
+                    details={'old_status': old_status, 'new_status': new_status, 'comment': operator_comment},
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    bulk=True
+                )
         
-        # ✅ Отправляем email ПОСЛЕ коммита (не блокирует транзакцию)
-        if new_status in ['cancelled_unpaid', 'cancelled_manual']:
-            try:
-                from app.utils.email import send_order_cancellation_email
-                send_order_cancellation_email(order, operator_comment)
-            except Exception as e:
-                logger.error(f"Error sending cancellation email: {e}")
+        _apply_status_change()
         
-        # Add system message to chat
-        try:
-            from app.api.chat_endpoints import _add_status_change_message
-            _add_status_change_message(order_id, new_status, operator_comment, current_user.id)
-        except ImportError:
-            logger.warning("Chat endpoints not available for status change message")
-        
-        # Log action
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='ORDER_STATUS_CHANGE',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={'old_status': old_status, 'new_status': new_status, 'comment': operator_comment},
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+        # ✅ Email об отмене отправляет фоновый воркер ПОСЛЕ коммита (SMTP не держит запрос)
+        if new_status in CANCELLED_STATUSES:
+            enqueue_notification(send_order_cancellation_task, order_id, operator_comment)
         
         return jsonify({
             'success': True,
@@ -517,28 +585,60 @@ def operator_change_order_status(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Operator change order status error: {str(e)}')
-        db.session.rollback()
-        return jsonify({
-            'success': False,
-            'error': _mask_internal_error(e, 'Не удалось изменить статус заказа')
-        }), 500
+        return _internal_error_response(e, 'Operator change order status error', 'Не удалось изменить статус заказа')
+
+# Колонки заказа, которые get_order_info отдает покупателю (служебные поля оператора не читаются)
+_CUSTOMER_ORDER_INFO_COLUMNS = (
+    Order.id,
+    Order.generated_order_number,
+    Order.status,
+    Order.customer_id,
+    Order.contact_email,
+    Order.contact_first_name,
+    Order.contact_last_name,
+    Order.contact_phone,
+    Order.comment,
+    Order.total_amount,
+    Order.paid_amount,
+    Order.payment_method,
+    Order.payment_expires_at,
+    Order.created_at,
+    Order.video_types,
+    Order.video_links,
+)
 
 @bp.route('/order/<int:order_id>/info', methods=['GET'])
 @login_required
 def get_order_info(order_id):
     """Get detailed order information"""
     try:
-        order = Order.query.get_or_404(order_id)
+        user = current_user._get_current_object()
+        is_staff = user.role in STAFF_ROLES
+        
+        if is_staff:
+            # ✅ Связанные объекты одним запросом (вместо отдельного SELECT на каждое обращение)
+            stmt = select(Order).options(
+                joinedload(Order.event),
+                joinedload(Order.category),
+                joinedload(Order.athlete),
+                joinedload(Order.customer),
+                joinedload(Order.operator)
+            )
+        else:
+            # ✅ Покупателю - только показываемые ему колонки, без оператора и служебных полей
+            stmt = select(Order).options(
+                load_only(*_CUSTOMER_ORDER_INFO_COLUMNS),
+                joinedload(Order.event).load_only(Event.id, Event.name),
+                joinedload(Order.category).load_only(Category.id, Category.name),
+                joinedload(Order.athlete).load_only(Athlete.id, Athlete.name)
+            )
+        order = db.session.execute(stmt.where(Order.id == order_id)).scalar_one_or_none()
+        if order is None:
+            return jsonify({'success': False, 'error': 'Заказ не найден'}), 404
         
         # Check access permissions
-        if current_user.role not in ['ADMIN', 'MOM', 'OPERATOR']:
-            if order.customer_id != current_user.id:
-                return jsonify({'success': False, 'error': 'Access denied'}), 403
-        
-        # Get video types
-        video_types = VideoType.query.all()
-        video_types_dict = {str(vt.id): vt for vt in video_types}
+        if not is_staff and order.customer_id != user.id:
+            return jsonify({'success': False, 'error': 'Access denied'}), 403
         
         # Prepare order data
         order_data = {
@@ -549,8 +649,6 @@ def get_order_info(order_id):
             'contact_first_name': order.contact_first_name,
             'contact_last_name': order.contact_last_name,
             'contact_phone': order.contact_phone,
-            'operator_comment': order.operator_comment,
-            'refund_reason': order.refund_reason,
             'comment': order.comment,
             'total_amount': float(order.total_amount),
             'paid_amount': float(order.paid_amount) if order.paid_amount else 0,
@@ -561,69 +659,58 @@ def get_order_info(order_id):
             'video_links': order.video_links or {},
             'video_types_info': {},
             'event': {
-                'id': order.event.id if order.event else None,
-                'name': order.event.name if order.event else 'Не указан'
+                'id': order.event.id,
+                'name': order.event.name
             } if order.event else {'id': None, 'name': 'Не указан'},
             'category': {
-                'id': order.category.id if order.category else None,
-                'name': order.category.name if order.category else 'Не указана'
+                'id': order.category.id,
+                'name': order.category.name
             } if order.category else {'id': None, 'name': 'Не указана'},
             'athlete': {
-                'id': order.athlete.id if order.athlete else None,
-                'name': order.athlete.name if order.athlete else 'Не указан'
+                'id': order.athlete.id,
+                'name': order.athlete.name
             } if order.athlete else {'id': None, 'name': 'Не указан'},
-            'customer': {
-                'id': order.customer.id if order.customer else None,
-                'full_name': order.customer.full_name if order.customer else None
-            } if order.customer else {'id': None, 'full_name': None},
-            'operator': {
-                'id': order.operator.id if order.operator else None,
-                'full_name': order.operator.full_name if order.operator else None
-            } if order.operator else {'id': None, 'full_name': None},
-            'processed_at': order.processed_at.isoformat() if order.processed_at else None
         }
         
+        if is_staff:
+            order_data.update({
+                'operator_comment': order.operator_comment,
+                'refund_reason': order.refund_reason,
+                'customer': {
+                    'id': order.customer.id,
+                    'full_name': order.customer.full_name
+                } if order.customer else {'id': None, 'full_name': None},
+                'operator': {
+                    'id': order.operator.id,
+                    'full_name': order.operator.full_name
+                } if order.operator else {'id': None, 'full_name': None},
+                'processed_at': order.processed_at.isoformat() if order.processed_at else None
+            })
+        else:
+            # Покупатель смотрит свой заказ - данные клиента уже есть в current_user
+            order_data['customer'] = {'id': user.id, 'full_name': user.full_name}
+        
         # Add video types info as array for JavaScript compatibility
         video_types_array = []
+        # ✅ Каталог типов видео из кеша процесса (обновляется по TTL и при изменении VideoType)
+        video_type_payloads = get_video_type_payloads()
         if order.video_types:
-            logger.info(f"Raw video_types for order {order.id}: {order.video_types}")
+            logger.debug("Raw video_types for order %s: %s", order.id, order.video_types)
             
             # Filter out empty arrays and invalid values
-            valid_video_types = []
-            for item in order.video_types:
-                logger.info(f"Processing item: {item}, type: {type(item)}")
-                if item is not None and item != [] and item != [[]] and item != {}:
-                    if isinstance(item, list):
-                        # If it's a list, check if it contains valid IDs
-                        for sub_item in item:
-                            if sub_item is not None and sub_item != [] and sub_item != {}:
-                                if isinstance(sub_item, list):
-                                    valid_video_types.extend(sub_item)
-                                else:
-                                    valid_video_types.append(sub_item)
-                    elif isinstance(item, dict):
-                        # If it's a dict, check if it has valid properties
-                        if 'id' in item and item['id'] is not None:
-                            valid_video_types.append(item['id'])
-                    else:
-                        valid_video_types.append(item)
+            valid_video_types = list(_flatten_video_type_ids(order.video_types))
             
-            logger.info(f"Valid video types for order {order.id}: {valid_video_types}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Valid video types for order %s: %s", order.id, valid_video_types)
             
             for video_type_id in valid_video_types:
-                # Try both string and int keys
-                vt = video_types_dict.get(str(video_type_id)) or video_types_dict.get(int(video_type_id))
-                if vt:
-                    video_types_array.append({
-                        'id': vt.id,
-                        'name': vt.name,
-                        'description': vt.description,
-                        'price': float(vt.price)
-                    })
+                payload = video_type_payloads.get(_to_video_type_id(video_type_id))
+                if payload:
+                    video_types_array.append(payload)
                     order_data['video_types_info'][str(video_type_id)] = {
-                        'name': vt.name,
-                        'description': vt.description,
-                        'price': float(vt.price)
+                        'name': payload['name'],
+                        'description': payload['description'],
+                        'price': payload['price']
                     }
                 else:
                     logger.warning(f"Video type with ID {video_type_id} not found in database")
@@ -632,16 +719,11 @@ def get_order_info(order_id):
         
         # If no video types found but we have video_links, try to extract from there
         if not video_types_array and order.video_links:
-            logger.info(f"No video_types found, trying to extract from video_links: {order.video_links}")
+            logger.debug("No video_types found, trying to extract from video_links: %s", order.video_links)
             for video_type_id in order.video_links.keys():
-                vt = video_types_dict.get(str(video_type_id)) or video_types_dict.get(int(video_type_id))
-                if vt:
-                    video_types_array.append({
-                        'id': vt.id,
-                        'name': vt.name,
-                        'description': vt.description,
-                        'price': float(vt.price)
-                    })
+                payload = video_type_payloads.get(_to_video_type_id(video_type_id))
+                if payload:
+                    video_types_array.append(payload)
             order_data['video_types'] = video_types_array
         
         return jsonify({
@@ -650,20 +732,18 @@ def get_order_info(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Get order info error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Не удалось получить информацию о заказе')}), 500
+        return _internal_error_response(e, 'Get order info error', 'Не удалось получить информацию о заказе')
 
 @bp.route('/order/<int:order_id>/send-links', methods=['POST'])
 @login_required
 def send_video_links_api(order_id):
     """Send video links via API"""
     try:
-        order = Order.query.get_or_404(order_id)
+        order = _get_order_or_404(order_id)
         
         # Get data from JSON or form
         if request.is_json:
-            data = request.get_json()
+            data = _json_body()
             video_links = data.get('video_links', {})
             customer_email = data.get('client_email', order.contact_email)
             customer_name = data.get('client_name', '')
@@ -681,10 +761,12 @@ def send_video_links_api(order_id):
             
             # Process each video type from form
             # Поддерживаем как старый формат (video_type_id), так и новый (video_type_id_index)
+            # ✅ Один проход по форме: strip один раз на поле
             for key, value in request.form.items():
-                if key.startswith('video_link_') and value.strip():
-                    field_key = key.replace('video_link_', '')
-                    video_links[field_key] = value.strip()
+                if key.startswith('video_link_'):
+                    value = value.strip()
+                    if value:
+                        video_links[key.removeprefix('video_link_')] = value
         
         if not video_links:
             return jsonify({'success': False, 'error': 'Необходимо указать хотя бы одну ссылку на видео'}), 400
@@ -700,12 +782,13 @@ def send_video_links_api(order_id):
         final_last_name = order.contact_last_name
 
         if customer_name:
-            name_parts = customer_name.strip().split(' ')
-            if len(name_parts) >= 2:
-                final_last_name = name_parts[0]
-                final_first_name = ' '.join(name_parts[1:])
-            elif len(name_parts) == 1:
-                final_first_name = name_parts[0]
+            # "Фамилия Имя Отчество": первое слово - фамилия, остальное - имя
+            last_part, _, first_part = customer_name.strip().partition(' ')
+            if first_part:
+                final_last_name = last_part
+                final_first_name = first_part
+            else:
+                final_first_name = last_part
 
         base_operator_comment = order.operator_comment or ''
         partial_flag = '[ТРЕБУЕТСЯ ЧАСТИЧНЫЙ ВОЗВРАТ]'
@@ -728,65 +811,55 @@ def send_video_links_api(order_id):
             final_operator_comment = base_operator_comment
 
         processed_at_value = moscow_now_naive()
-        final_operator_id = order.operator_id or current_user.id
+        user_id = current_user.id
+        final_operator_id = order.operator_id or user_id
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
 
+        @sqlite_retry()
         def _apply_video_links_update():
-            fresh_order = Order.query.get(order.id)
-            if not fresh_order:
-                raise ValueError('Order not found during send links update')
-            fresh_order.video_links = final_video_links
-            fresh_order.contact_email = final_contact_email
-            fresh_order.contact_first_name = final_first_name
-            fresh_order.contact_last_name = final_last_name
-            fresh_order.status = 'links_sent'
-            fresh_order.operator_comment = final_operator_comment
-            fresh_order.refund_reason = final_refund_reason
-            fresh_order.processed_at = processed_at_value
-            if not fresh_order.operator_id and final_operator_id:
-                fresh_order.operator_id = final_operator_id
-
-        _execute_db_operation_with_retry(
-            _apply_video_links_update,
-            'api.send_video_links.update_order'
-        )
+            with sqlite_write_tx():
+                fresh_order = db.session.get(Order, order.id)
+                if not fresh_order:
+                    raise ValueError('Order not found during send links update')
+                fresh_order.video_links = final_video_links
+                fresh_order.contact_email = final_contact_email
+                fresh_order.contact_first_name = final_first_name
+                fresh_order.contact_last_name = final_last_name
+                fresh_order.status = 'links_sent'
+                fresh_order.operator_comment = final_operator_comment
+                fresh_order.refund_reason = final_refund_reason
+                fresh_order.processed_at = processed_at_value
+                fresh_order.updated_at = processed_at_value
+                if not fresh_order.operator_id and final_operator_id:
+                    fresh_order.operator_id = final_operator_id
+
+                # ✅ Аудит пишется в той же транзакции, что и заказ (один COMMIT)
+                AuditLog.create_log(
+                    user_id=user_id,
+                    action='LINKS_SENT',
+                    resource_type='Order',
+                    resource_id=str(fresh_order.id),
+                    details={
+                        'video_links': video_links,
+                        'message': message,
+                        'customer_email': customer_email,
+                        'partial_refund': partial_refund,
+                        'refund_comment': refund_comment if partial_refund else None
+                    },
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    bulk=True
+                )
+
+        _apply_video_links_update()
 
         db.session.refresh(order)
         
-        # Send email with links
-        try:
-            from app.utils.email import send_video_links_email
-            send_video_links_email(order)
-        except Exception as e:
-            logger.error(f'Failed to send email: {e}')
-            # Don't fail the whole operation if email fails
-        
-        # Send Telegram notification with links (if user has telegram_id)
+        # ✅ Email и Telegram отправляются в фоновом потоке, не блокируя ответ
         # ✅ 152-ФЗ: Не логируем email на уровне INFO
-        logger.info(f"[API] About to send Telegram notification for order {order.id}")
-        try:
-            from app.utils.telegram_notifier import send_video_links_notification
-            result = send_video_links_notification(order)
-            logger.info(f"[API] Telegram notification result for order {order.id}: {result}")
-        except Exception as e:
-            logger.error(f'[API] Failed to send Telegram notification with links: {e}', exc_info=True)
-            # Don't fail the whole operation if Telegram notification fails
-        
-        # Log action
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='LINKS_SENT',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={
-                'video_links': video_links, 
-                'message': message,
-                'customer_email': customer_email,
-                'partial_refund': partial_refund,
-                'refund_comment': refund_comment if partial_refund else None
-            },
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+        logger.info("[API] Queueing video links notifications for order %s", order.id)
+        enqueue_notification(send_video_links_task, order.id)
         
         return jsonify({
             'success': True,
@@ -794,9 +867,7 @@ def send_video_links_api(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Send video links error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка отправки ссылок')}), 500
+        return _internal_error_response(e, 'Send video links error', 'Ошибка отправки ссылок')
 
 @bp.route('/order/<int:order_id>/assign-operator', methods=['POST'])
 @login_required
@@ -804,37 +875,52 @@ def send_video_links_api(order_id):
 def assign_operator_api(order_id):
     """Assign operator to order (only for paid orders)"""
     try:
-        from sqlalchemy import select
-        from sqlalchemy.exc import OperationalError
-        
-        # ✅ ИСПОЛЬЗУЕМ SELECT FOR UPDATE для блокировки строки
-        # Flask автоматически создает транзакцию для каждого request, поэтому
-        # не используем db.session.begin() - это вызовет ошибку "transaction already begun"
+        user = current_user._get_current_object()
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        # ✅ SELECT ... FOR UPDATE SKIP LOCKED: на PostgreSQL второй оператор, кликнувший
+        # ✅ "взять заказ" одновременно, сразу получает 409 вместо ожидания чужого COMMIT.
+        # ✅ SQLite не поддерживает FOR UPDATE - там строку защищает sqlite_write_tx
+        # ✅ (BEGIN IMMEDIATE берет блокировку записи до SELECT, проверка и UPDATE атомарны)
         try:
-            # Блокируем строку заказа для обновления (защита от race condition)
-            stmt = select(Order).where(
-                Order.id == order_id,
-                Order.status == 'paid',
-                Order.operator_id.is_(None)  # ✅ Проверяем, что оператор еще не назначен
-            ).with_for_update()
-            
-            order = db.session.scalar(stmt)
+            with sqlite_write_tx():
+                stmt = select(Order).where(
+                    Order.id == order_id,
+                    Order.status == 'paid',
+                    Order.operator_id.is_(None)  # ✅ Проверяем, что оператор еще не назначен
+                ).with_for_update(skip_locked=True)
+                
+                order = db.session.scalar(stmt)
+                
+                if order:
+                    # Проверка прав уже сделана выше
+                    # Назначаем оператора
+                    order.operator_id = user.id
+                    order.status = 'processing'
+                    order.processed_at = moscow_now_naive()
+                    
+                    # ✅ Аудит в той же транзакции: INSERT и UPDATE уходят одним COMMIT
+                    AuditLog.create_log(
+                        user_id=user.id,
+                        action='OPERATOR_TOOK_ORDER',
+                        resource_type='Order',
+                        resource_id=str(order.id),
+                        details={
+                            'assigned_operator': user.full_name,
+                            'order_status': 'processing',
+                            'paid_amount': float(order.paid_amount)
+                        },
+                        ip_address=ip_address,
+                        user_agent=user_agent,
+                        bulk=True
+                    )
             
+            # Не найден: уже взят, не оплачен или прямо сейчас назначается другим оператором (SKIP LOCKED)
             if not order:
-                db.session.rollback()
                 return jsonify({
                     'success': False, 
                     'error': 'Заказ недоступен (уже взят другим оператором или не оплачен)'
                 }), 409
-            
-            # Проверка прав уже сделана выше
-            # Назначаем оператора
-            order.operator_id = current_user.id
-            order.status = 'processing'
-            order.processed_at = moscow_now_naive()
-            
-            # Коммитим транзакцию (Flask автоматически создал её для этого request)
-            db.session.commit()
                 
         except OperationalError as e:
             # Если произошла ошибка блокировки (редко, но возможно)
@@ -842,31 +928,13 @@ def assign_operator_api(order_id):
             logger.error(f'Database lock error assigning operator: {str(e)}')
             return jsonify({'success': False, 'error': 'Заказ уже обрабатывается другим оператором'}), 409
         
-        # Логирование после успешного коммита
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='OPERATOR_TOOK_ORDER',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={
-                'assigned_operator': current_user.full_name,
-                'order_status': 'processing',
-                'paid_amount': float(order.paid_amount)
-            },
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent'),
-            commit=True  # ✅ Коммитим отдельно, т.к. основная транзакция уже завершена
-        )
-        
         return jsonify({
             'success': True,
             'message': 'Заказ взят в работу успешно'
         })
         
     except Exception as e:
-        logger.error(f'Assign operator error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка назначения оператора')}), 500
+        return _internal_error_response(e, 'Assign operator error', 'Ошибка назначения оператора')
 
 @bp.route('/order/<int:order_id>/capture', methods=['POST'])
 @login_required
@@ -874,30 +942,36 @@ def assign_operator_api(order_id):
 def capture_payment(order_id):
     """Capture (confirm) payment for mom"""
     try:
-        order = Order.query.get_or_404(order_id)
+        user = current_user._get_current_object()
+        order = _get_order_or_404(order_id)
         
         # Check if order can be captured
         if not order.can_be_captured_by_mom():
             return jsonify({'success': False, 'error': 'Заказ не может быть зачтен в текущем статусе'}), 409
         
-        data = request.get_json()
+        data = _json_body()
         capture_amount = data.get('amount')
         
         if not capture_amount:
             return jsonify({'success': False, 'error': 'Сумма к зачету не указана'}), 400
         
-        capture_amount = float(capture_amount)
+        try:
+            capture_amount = float(capture_amount)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Некорректная сумма к зачету'}), 400
         
         if capture_amount <= 0:
             return jsonify({'success': False, 'error': 'Сумма к зачету должна быть больше нуля'}), 400
         
         # Ищем платеж: сначала авторизованный (для capture), затем подтвержденный (для подтверждения получения денег)
-        payment = order.payments.filter_by(status='authorized').first()
+        # ✅ Оба статуса одним запросом
+        payments_by_status = _find_order_payments(order.id, 'authorized', 'confirmed')
+        payment = payments_by_status.get('authorized')
         is_already_confirmed = False
         
         if not payment:
-            # Если нет авторизованного платежа, ищем подтвержденный
-            payment = order.payments.filter_by(status='confirmed').first()
+            # Если нет авторизованного платежа, берем подтвержденный
+            payment = payments_by_status.get('confirmed')
             if payment:
                 is_already_confirmed = True
             else:
@@ -917,9 +991,16 @@ def capture_payment(order_id):
             }), 400
         
         audit_entries = []
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        # ✅ Состояние, по которому принято решение: перепроверяется под блокировкой строки перед записью
+        expected_status = order.status
+        expected_paid_amount = order.paid_amount
         new_order_status = order.status
         new_paid_amount = order.paid_amount
         new_payment_amount_override = None
+        needs_confirm = False
+        confirm_amount = None  # ✅ Сумма для confirm в CloudPayments: None - подтверждаем полностью
 
         if is_already_confirmed:
             new_paid_amount = capture_amount
@@ -938,14 +1019,9 @@ def capture_payment(order_id):
                 }
             })
         else:
-            cp_api = CloudPaymentsAPI()
             if order.payment_method == 'card':
-                is_partial_capture = capture_amount < float(order.total_amount)
-
-                if is_partial_capture:
-                    confirm_result = cp_api.confirm_payment(payment.cp_transaction_id, capture_amount)
-                    if not confirm_result.get('success'):
-                        return jsonify({'success': False, 'error': f'Ошибка подтверждения платежа: {confirm_result.get("error")}'}), 500
+                if capture_amount < float(order.total_amount):
+                    confirm_amount = capture_amount
                     new_order_status = 'completed_partial_refund'
                     new_paid_amount = capture_amount
                     new_payment_amount_override = capture_amount
@@ -960,9 +1036,6 @@ def capture_payment(order_id):
                         }
                     })
                 else:
-                    confirm_result = cp_api.confirm_payment(payment.cp_transaction_id)
-                    if not confirm_result.get('success'):
-                        return jsonify({'success': False, 'error': f'Ошибка подтверждения платежа: {confirm_result.get("error")}'}), 500
                     new_order_status = 'completed'
                     new_paid_amount = capture_amount
                     audit_entries.append({
@@ -972,6 +1045,7 @@ def capture_payment(order_id):
                             'transaction_id': payment.cp_transaction_id
                         }
                     })
+                needs_confirm = True
             else:
                 new_paid_amount = capture_amount
                 if capture_amount < float(order.total_amount):
@@ -986,37 +1060,54 @@ def capture_payment(order_id):
                     }
                 })
 
-        confirmed_at_value = moscow_now_naive()
+        # ✅ Одна отметка времени на запрос: заказ, платеж и аудит получают одинаковое время
+        changed_at = moscow_now_naive()
+        payment_id = payment.id
+        transaction_id = payment.cp_transaction_id
+        audit_rows = [{
+            'user_id': user.id,
+            'action': entry['action'],
+            'resource_type': 'Order',
+            'resource_id': str(order.id),
+            'details': entry['details'],
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'created_at': changed_at,
+        } for entry in audit_entries]
+
+        # ✅ Захватываем заказ условным UPDATE до confirm в CloudPayments: параллельные
+        # ✅ отмена/возврат получат 409, а не списание по уже измененному заказу
+        if not _transition_order(order_id, expected_status, expected_paid_amount,
+                                 new_order_status, new_paid_amount, changed_at):
+            logger.warning('Capture for order %s rejected: the order changed concurrently', order_id)
+            return jsonify({'success': False, 'error': 'Заказ был изменен другим пользователем, обновите страницу'}), 409
 
+        if needs_confirm:
+            confirm_result = get_cloudpayments_api().confirm_payment(transaction_id, confirm_amount)
+            if not confirm_result.get('success'):
+                # ✅ Списание не прошло - возвращаем заказу прежние статус и сумму
+                if not _transition_order(order_id, new_order_status, new_paid_amount,
+                                         expected_status, expected_paid_amount, moscow_now_naive()):
+                    logger.error('Capture for order %s failed and the order claim could not be released', order_id)
+                return jsonify({'success': False, 'error': f'Ошибка подтверждения платежа: {confirm_result.get("error")}'}), 500
+
+        @sqlite_retry()
         def _apply_capture_changes():
-            fresh_order = Order.query.get(order.id)
-            fresh_payment = Payment.query.get(payment.id)
-            if not fresh_order or not fresh_payment:
-                raise ValueError('Order or payment not found during capture persistence')
-            fresh_order.status = new_order_status
-            fresh_order.paid_amount = new_paid_amount
-            fresh_payment.status = 'confirmed'
-            fresh_payment.mom_confirmed = True
-            fresh_payment.confirmed_at = confirmed_at_value
-            fresh_payment.confirmed_by = current_user.id
-            if new_payment_amount_override is not None:
-                fresh_payment.amount = new_payment_amount_override
-            for entry in audit_entries:
-                AuditLog.create_log(
-                    user_id=current_user.id,
-                    action=entry['action'],
-                    resource_type='Order',
-                    resource_id=str(order.id),
-                    details=entry['details'],
-                    ip_address=request.remote_addr,
-                    user_agent=request.headers.get('User-Agent'),
-                    commit=False
-                )
+            with sqlite_write_tx():
+                fresh_payment = db.session.get(Payment, payment_id)
+                if not fresh_payment:
+                    raise ValueError('Payment not found during capture persistence')
+                fresh_payment.status = 'confirmed'
+                fresh_payment.mom_confirmed = True
+                fresh_payment.confirmed_at = changed_at
+                fresh_payment.updated_at = changed_at
+                fresh_payment.confirmed_by = user.id
+                if new_payment_amount_override is not None:
+                    fresh_payment.amount = new_payment_amount_override
+                AuditLog.create_logs_bulk(audit_rows)
 
-        _execute_db_operation_with_retry(
-            _apply_capture_changes,
-            'api.capture_payment.persist'
-        )
+        # ✅ Заказ уже переведен при захвате: деньги списаны, платеж и аудит пишем без проверки статуса
+        _apply_capture_changes()
         
         return jsonify({
             'success': True,
@@ -1025,9 +1116,7 @@ def capture_payment(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Capture payment error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка зачета платежа')}), 500
+        return _internal_error_response(e, 'Capture payment error', 'Ошибка зачета платежа')
 
 @bp.route('/order/<int:order_id>/refund', methods=['POST'])
 @login_required
@@ -1035,29 +1124,39 @@ def capture_payment(order_id):
 def refund_payment(order_id):
     """Refund payment"""
     try:
-        order = Order.query.get_or_404(order_id)
+        user = current_user._get_current_object()
+        order = db.session.get(Order, order_id)
+        if not order:
+            return jsonify({'success': False, 'error': 'Заказ не найден'}), 404
         
-        data = request.get_json()
+        if order.status == 'refunded_full':
+            return jsonify({'success': False, 'error': 'По заказу уже выполнен полный возврат'}), 409
+        
+        data = _json_body()
         refund_amount = data.get('amount')  # If None, full refund
         
         if refund_amount:
-            refund_amount = float(refund_amount)
+            try:
+                refund_amount = float(refund_amount)
+            except (TypeError, ValueError):
+                return jsonify({'success': False, 'error': 'Некорректная сумма возврата'}), 400
             if refund_amount <= 0:
                 return jsonify({'success': False, 'error': 'Некорректная сумма возврата'}), 400
         
         # Find the payment - можно вернуть только confirmed платежи
-        payment = order.payments.filter_by(status='confirmed').first()
+        # ✅ confirmed и authorized одним запросом
+        payments_by_status = _find_order_payments(order.id, 'confirmed', 'authorized')
+        payment = payments_by_status.get('confirmed')
         if not payment:
             # Проверим, есть ли authorized платежи (для них нужен void, не refund)
-            authorized_payment = order.payments.filter_by(status='authorized').first()
-            if authorized_payment:
+            if 'authorized' in payments_by_status:
                 return jsonify({
                     'success': False, 
                     'error': 'Платеж еще не подтвержден. Используйте отмену платежа вместо возврата.'
                 }), 400
             return jsonify({'success': False, 'error': 'Подтвержденный платеж не найден'}), 404
         
-        cp_api = CloudPaymentsAPI()
+        cp_api = get_cloudpayments_api()
         
         # ✅ Определяем сумму возврата
         if refund_amount is None:
@@ -1083,12 +1182,11 @@ def refund_payment(order_id):
                 'error': f'Сумма возврата ({refund_amount}) превышает оплаченную сумму заказа ({order.paid_amount})'
             }), 400
         
-        # Perform refund через CloudPayments API
-        refund_result = cp_api.refund_payment(payment.cp_transaction_id, refund_amount)
-        if not refund_result.get('success'):
-            return jsonify({'success': False, 'error': f'Ошибка возврата: {refund_result.get("error")}'}), 500
-        
-        # ✅ Определяем тип возврата и обновляем статусы
+        # ✅ Определяем тип возврата и новые статусы
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        expected_status = order.status
+        expected_paid_amount = order.paid_amount
         original_paid_amount = float(order.paid_amount or 0)
         is_full_refund = refund_amount >= original_paid_amount
 
@@ -1097,7 +1195,7 @@ def refund_payment(order_id):
             new_payment_status = 'refunded_full'
             new_paid_amount = 0
             audit_entries = [{
-                'user_id': current_user.id,
+                'user_id': user.id,
                 'action': 'MOM_REFUNDED_FULL',
                 'details': {
                     'refund_amount': original_paid_amount,
@@ -1110,7 +1208,7 @@ def refund_payment(order_id):
             remaining_amount = original_paid_amount - refund_amount
             new_paid_amount = remaining_amount
             audit_entries = [{
-                'user_id': current_user.id,
+                'user_id': user.id,
                 'action': 'MOM_REFUNDED_PARTIAL',
                 'details': {
                     'refund_amount': refund_amount,
@@ -1119,31 +1217,48 @@ def refund_payment(order_id):
                 }
             }]
 
+        # ✅ Одна отметка времени на запрос: заказ, платеж и аудит получают одинаковое время
+        changed_at = moscow_now_naive()
+        audit_rows = [{
+            'user_id': entry['user_id'],
+            'action': entry['action'],
+            'resource_type': 'Order',
+            'resource_id': str(order.id),
+            'details': entry['details'],
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'created_at': changed_at,
+        } for entry in audit_entries]
+
+        # ✅ Захватываем заказ условным UPDATE до вызова CloudPayments: параллельный возврат
+        # ✅ (или capture) по тому же заказу получит 409, а не второй возврат денег
+        if not _transition_order(order_id, expected_status, expected_paid_amount,
+                                 new_order_status, new_paid_amount, changed_at):
+            logger.warning('Refund for order %s rejected: the order changed concurrently', order_id)
+            return jsonify({'success': False, 'error': 'Заказ был изменен другим пользователем, обновите страницу'}), 409
+
+        # Perform refund через CloudPayments API
+        refund_result = cp_api.refund_payment(payment.cp_transaction_id, refund_amount)
+        if not refund_result.get('success'):
+            # ✅ Возврат не прошел - возвращаем заказу прежние статус и сумму
+            if not _transition_order(order_id, new_order_status, new_paid_amount,
+                                     expected_status, expected_paid_amount, moscow_now_naive()):
+                logger.error('Refund for order %s failed and the order claim could not be released', order_id)
+            return jsonify({'success': False, 'error': f'Ошибка возврата: {refund_result.get("error")}'}), 500
+
+        @sqlite_retry()
         def _apply_refund_changes():
-            fresh_order = Order.query.get(order.id)
-            fresh_payment = Payment.query.get(payment.id)
-            if not fresh_order or not fresh_payment:
-                raise ValueError('Order or payment not found during refund persistence')
-            fresh_order.status = new_order_status
-            fresh_order.paid_amount = new_paid_amount
-            fresh_payment.status = new_payment_status
-
-            for entry in audit_entries:
-                AuditLog.create_log(
-                    user_id=entry['user_id'],
-                    action=entry['action'],
-                    resource_type='Order',
-                    resource_id=str(order.id),
-                    details=entry['details'],
-                    ip_address=request.remote_addr,
-                    user_agent=request.headers.get('User-Agent'),
-                    commit=False
-                )
+            with sqlite_write_tx():
+                fresh_payment = db.session.get(Payment, payment.id)
+                if not fresh_payment:
+                    raise ValueError('Payment not found during refund persistence')
+                fresh_payment.status = new_payment_status
+                fresh_payment.updated_at = changed_at
 
-        _execute_db_operation_with_retry(
-            _apply_refund_changes,
-            'api.refund_payment.persist'
-        )
+                AuditLog.create_logs_bulk(audit_rows)
+
+        # ✅ Заказ уже переведен при захвате: деньги возвращены, платеж и аудит пишем без проверки статуса
+        _apply_refund_changes()
         
         return jsonify({
             'success': True,
@@ -1152,9 +1267,7 @@ def refund_payment(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Refund payment error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка возврата')}), 500
+        return _internal_error_response(e, 'Refund payment error', 'Ошибка возврата')
 
 @bp.route('/order/<int:order_id>/cancel', methods=['POST'])
 @login_required
@@ -1162,55 +1275,71 @@ def refund_payment(order_id):
 def cancel_order(order_id):
     """Cancel order manually (admin only)"""
     try:
-        order = Order.query.get_or_404(order_id)
+        order = _get_order_or_404(order_id)
         
-        data = request.get_json()
+        data = _json_body()
         cancellation_reason = data.get('reason', 'Отменен администратором')
         
-        void_succeeded = False
+        user_id = current_user.id
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        expected_status = order.status
+        expected_paid_amount = order.paid_amount
+        transaction_id = order.payment_intent_id
         authorized_payment_id = None
-        if order.payment_intent_id:
+        if transaction_id:
             payment = order.payments.filter_by(
-                cp_transaction_id=order.payment_intent_id,
+                cp_transaction_id=transaction_id,
                 status='authorized'
             ).first()
             if payment:
-                cp_api = CloudPaymentsAPI()
-                void_result = cp_api.void_payment(order.payment_intent_id)
-                if void_result.get('success'):
-                    void_succeeded = True
-                    authorized_payment_id = payment.id
-                    logger.info(f'Payment {order.payment_intent_id} voided for cancelled order {order.id}')
+                authorized_payment_id = payment.id
+        changed_at = moscow_now_naive()
+
+        # ✅ Захватываем заказ условным UPDATE до void в CloudPayments: параллельный capture
+        # ✅ получит 409, а не спишет деньги по отмененному заказу
+        if not _transition_order(order_id, expected_status, expected_paid_amount,
+                                 'cancelled_manual', expected_paid_amount, changed_at):
+            logger.warning('Cancellation of order %s rejected: the order changed concurrently', order_id)
+            return jsonify({'success': False, 'error': 'Заказ был изменен другим пользователем, обновите страницу'}), 409
+
+        if authorized_payment_id:
+            void_result = get_cloudpayments_api().void_payment(transaction_id)
+            if not void_result.get('success'):
+                # ✅ Отмена платежа не прошла - возвращаем заказу прежний статус
+                if not _transition_order(order_id, 'cancelled_manual', expected_paid_amount,
+                                         expected_status, expected_paid_amount, moscow_now_naive()):
+                    logger.error('Void for order %s failed and the order claim could not be released', order_id)
+                return jsonify({'success': False, 'error': f'Ошибка отмены платежа: {void_result.get("error")}'}), 500
+            logger.info('Payment %s voided for cancelled order %s', transaction_id, order_id)
 
+        @sqlite_retry()
         def _apply_cancellation():
-            fresh_order = Order.query.get(order.id)
-            if not fresh_order:
-                raise ValueError('Order not found during cancellation')
-            fresh_order.status = 'cancelled_manual'
-            fresh_order.cancellation_reason = cancellation_reason
-            if void_succeeded and authorized_payment_id:
-                fresh_payment = Payment.query.get(authorized_payment_id)
-                if fresh_payment:
-                    fresh_payment.status = 'voided'
-
-        _execute_db_operation_with_retry(
-            _apply_cancellation,
-            'api.cancel_order.persist'
-        )
-        
-        # Log cancellation
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='ORDER_CANCELLED_MANUAL',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={
-                'cancellation_reason': cancellation_reason,
-                'order_status': order.status
-            },
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+            with sqlite_write_tx():
+                fresh_order = db.session.get(Order, order_id)
+                fresh_order.cancellation_reason = cancellation_reason
+                if authorized_payment_id:
+                    fresh_payment = db.session.get(Payment, authorized_payment_id)
+                    if fresh_payment:
+                        fresh_payment.status = 'voided'
+
+                # ✅ Аудит в той же транзакции, что и запись причины отмены
+                AuditLog.create_log(
+                    user_id=user_id,
+                    action='ORDER_CANCELLED_MANUAL',
+                    resource_type='Order',
+                    resource_id=str(order_id),
+                    details={
+                        'cancellation_reason': cancellation_reason,
+                        'order_status': 'cancelled_manual'
+                    },
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    bulk=True
+                )
+
+        # ✅ Заказ уже переведен при захвате: причину, платеж и аудит пишем без проверки статуса
+        _apply_cancellation()
         
         return jsonify({
             'success': True,
@@ -1218,102 +1347,91 @@ def cancel_order(order_id):
         })
         
     except Exception as e:
-        logger.error(f'Cancel order error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка отмены заказа')}), 500
+        return _internal_error_response(e, 'Cancel order error', 'Ошибка отмены заказа')
 
 @bp.route('/payment/create-intent', methods=['POST'])
 @login_required
 def create_payment_intent():
     """Create payment intent and set order to awaiting_payment"""
     try:
-        data = request.get_json()
+        user = current_user._get_current_object()
+        data = _json_body()
         order_id = data.get('order_id')
         payment_method = data.get('payment_method', 'card')
         
         if not order_id:
             return jsonify({'success': False, 'error': 'Order ID required'}), 400
         
-        order = Order.query.get_or_404(order_id)
+        order = _get_order_or_404(order_id)
         
         # Check if user has access to this order
-        if current_user.role not in ['ADMIN', 'MOM', 'OPERATOR']:
-            if order.customer_id != current_user.id:
+        if user.role not in STAFF_ROLES:
+            if order.customer_id != user.id:
                 return jsonify({'success': False, 'error': 'Access denied'}), 403
         
         # Check if order is in correct status
         if order.status != 'checkout_initiated':
             return jsonify({'success': False, 'error': 'Order is not in checkout_initiated status'}), 409
         
+        # ✅ Сначала готовим данные виджета (без записи в БД), чтобы при ошибке не откатывать статус
+        cp_api = get_cloudpayments_api()
+        payment_data = cp_api.create_payment_widget_data(order, payment_method)
+        
+        if not payment_data:
+            return jsonify({'success': False, 'error': 'Failed to create payment intent'}), 500
+        
         # Update order status and set payment expiration
         from datetime import timedelta
         payment_expiration = moscow_now_naive() + timedelta(minutes=15)
+        user_id = user.id
+        order_pk = order.id
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
 
+        @sqlite_retry()
         def _mark_order_awaiting_payment():
-            fresh_order = Order.query.get(order.id)
-            if not fresh_order:
-                raise ValueError('Order not found during payment intent creation')
-            fresh_order.status = 'awaiting_payment'
-            fresh_order.payment_method = payment_method
-            fresh_order.payment_expires_at = payment_expiration
-
-        _execute_db_operation_with_retry(
-            _mark_order_awaiting_payment,
-            'api.create_payment_intent.awaiting_payment'
-        )
-        
-        # Create payment widget data
-        cp_api = CloudPaymentsAPI()
-        payment_data = cp_api.create_payment_widget_data(order, payment_method)
-        
-        if not payment_data:
-            def _rollback_payment_intent_state():
-                fresh_order = Order.query.get(order.id)
+            with sqlite_write_tx():
+                fresh_order = db.session.get(Order, order.id)
                 if not fresh_order:
-                    return
-                fresh_order.status = 'checkout_initiated'
-                fresh_order.payment_method = None
-                fresh_order.payment_expires_at = None
-
-            _execute_db_operation_with_retry(
-                _rollback_payment_intent_state,
-                'api.create_payment_intent.rollback'
-            )
-            return jsonify({'success': False, 'error': 'Failed to create payment intent'}), 500
-        
-        # Log payment intent creation
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='PAYMENT_INTENT_CREATED',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={
-                'payment_method': payment_method,
-                'expires_at': order.payment_expires_at.isoformat(),
-                'amount': float(order.total_amount)
-            },
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+                    raise ValueError('Order not found during payment intent creation')
+                fresh_order.status = 'awaiting_payment'
+                fresh_order.payment_method = payment_method
+                fresh_order.payment_expires_at = payment_expiration
+            
+                # Log payment intent creation (тем же COMMIT, что и смена статуса)
+                AuditLog.create_log(
+                    user_id=user_id,
+                    action='PAYMENT_INTENT_CREATED',
+                    resource_type='Order',
+                    resource_id=str(fresh_order.id),
+                    details={
+                        'payment_method': payment_method,
+                        'expires_at': payment_expiration.isoformat(),
+                        'amount': float(fresh_order.total_amount)
+                    },
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    bulk=True
+                )
+
+        _mark_order_awaiting_payment()
         
+        # ✅ Значения из локальных переменных: после COMMIT заказ expired, обращение к нему - лишний SELECT
         return jsonify({
             'success': True,
             'payment_data': payment_data,
-            'order_id': order.id,
-            'expires_at': order.payment_expires_at.isoformat()
+            'order_id': order_pk,
+            'expires_at': payment_expiration.isoformat()
         })
         
     except Exception as e:
-        logger.error(f'Create payment intent error: {str(e)}')
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка создания платежа')}), 500
+        return _internal_error_response(e, 'Create payment intent error', 'Ошибка создания платежа')
 
 @bp.route('/order/create', methods=['POST'])
 def create_order():
     """Create order from cart data"""
     try:
-        from flask import session
-        from app.models import Athlete, VideoType, User
+        user = current_user._get_current_object()
         
         # Get cart from session
         cart = session.get('cart', {})
@@ -1322,7 +1440,7 @@ def create_order():
             return jsonify({'success': False, 'error': 'Корзина пуста'}), 400
         
         # Get form data
-        data = request.get_json()
+        data = _json_body()
         contact_email = data.get('contact_email')
         contact_phone = data.get('contact_phone')
         contact_first_name = data.get('contact_first_name', '')
@@ -1348,71 +1466,91 @@ def create_order():
         contact_phone = normalized_phone
         
         # ✅ ВАЛИДАЦИЯ EMAIL
-        try:
-            from email_validator import validate_email, EmailNotValidError
-            validate_email(contact_email, check_deliverability=False)
-        except EmailNotValidError as e:
-            return jsonify({'success': False, 'error': f'Неверный формат email: {str(e)}'}), 400
-        except ImportError:
+        if EMAIL_VALIDATOR_AVAILABLE:
+            try:
+                validate_email(contact_email, check_deliverability=False)
+            except EmailNotValidError as e:
+                return jsonify({'success': False, 'error': f'Неверный формат email: {str(e)}'}), 400
+        elif not _EMAIL_RE.match(contact_email):
             # Если email_validator не установлен, используем простую проверку
-            import re
-            email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-            if not re.match(email_pattern, contact_email):
-                return jsonify({'success': False, 'error': 'Неверный формат email'}), 400
+            return jsonify({'success': False, 'error': 'Неверный формат email'}), 400
         
         # Clean up any existing pending orders from session
         pending_order_id = session.get('pending_order_id')
+        stale_order_delete = None
         if pending_order_id:
-            # ✅ Проверка наличия заказа перед удалением
-            old_order = Order.query.filter_by(id=pending_order_id).first()
-            if old_order and old_order.status == 'checkout_initiated':
-                db.session.delete(old_order)
-                db.session.commit()
-            session.pop('pending_order_id', None)
+            # ✅ Один условный DELETE вместо SELECT + проверки статуса + DELETE
+            # ✅ Коммитится вместе с созданием нового заказа (одна транзакция)
+            stale_order_delete = delete(Order).where(
+                Order.id == pending_order_id,
+                Order.status == 'checkout_initiated'
+            )
+            # ✅ pending_order_id не трогаем до коммита: он перезаписывается один раз ниже,
+            # ✅ а при ошибке сессия продолжает указывать на еще существующий заказ
         
         # Process cart items
-        cart_items = []
+        # ✅ Нужны только сумма, список типов видео и первый спортсмен - не храним ORM-объекты по позициям
         total_amount = 0
         video_types = []
+        first_athlete = None
+        first_event_id = None
         
+        # ✅ Сначала разбираем все позиции, затем два IN-запроса вместо двух SELECT на каждую позицию
+        cart_items = []
         for item_id, quantity in cart.items():
-            try:
-                athlete_id, video_type_id = map(int, item_id.split('_'))
-                # ✅ Используем get_or_404 или проверку - в этом случае проверка оправдана
-                athlete = Athlete.query.filter_by(id=athlete_id).first()
-                video_type = VideoType.query.filter_by(id=video_type_id).first()
-                
-                if athlete and video_type:
-                    item_total = video_type.price * quantity
-                    total_amount += item_total
-                    
-                    cart_items.append({
-                        'athlete': athlete,
-                        'video_type': video_type,
-                        'quantity': quantity,
-                        'total': item_total
-                    })
-                    
-                    # Add video type to order
-                    for _ in range(quantity):
-                        video_types.append(video_type_id)
-                else:
-                    return jsonify({'success': False, 'error': f'Товар {item_id} не найден'}), 400
-            except (ValueError, AttributeError):
+            parsed_key = _parse_cart_key(item_id)
+            if parsed_key is None:
                 return jsonify({'success': False, 'error': f'Ошибка в данных товара {item_id}'}), 400
+            cart_items.append((item_id, *parsed_key, quantity))
+        
+        # ✅ Категория подгружается тем же SELECT (нужен event_id для заказа)
+        athletes_by_id = {
+            athlete.id: athlete
+            for athlete in db.session.scalars(
+                select(Athlete)
+                .options(joinedload(Athlete.category))
+                .where(Athlete.id.in_({item[1] for item in cart_items}))
+            )
+        }
+        video_types_by_id = {
+            video_type.id: video_type
+            for video_type in db.session.scalars(
+                select(VideoType).where(VideoType.id.in_({item[2] for item in cart_items}))
+            )
+        }
         
-        if not cart_items:
+        for item_id, athlete_id, video_type_id, quantity in cart_items:
+            athlete = athletes_by_id.get(athlete_id)
+            video_type = video_types_by_id.get(video_type_id)
+            if not athlete or not video_type:
+                return jsonify({'success': False, 'error': f'Товар {item_id} не найден'}), 400
+            # ✅ Спортсмен без категории - битые данные, а не исключение из athlete.category.event_id
+            if athlete.category is None:
+                return jsonify({'success': False, 'error': f'Ошибка в данных товара {item_id}'}), 400
+            
+            total_amount += video_type.price * quantity
+            if first_athlete is None:
+                first_athlete = athlete
+                first_event_id = athlete.category.event_id
+            
+            # Add video type to order (repeat без промежуточного списка)
+            video_types.extend(repeat(video_type_id, quantity))
+        
+        if first_athlete is None:
             return jsonify({'success': False, 'error': 'Корзина пуста или содержит некорректные товары'}), 400
         
         # Get or create customer user (or use test mode)
         customer_id = None
-        if current_user.is_authenticated:
-            customer_id = current_user.id
+        new_user = None
+        if user.is_authenticated:
+            customer_id = user.id
         else:
-            # Check if user already exists
-            existing_user = User.query.filter_by(email=contact_email).first()
-            if existing_user:
-                customer_id = existing_user.id
+            # Check if user already exists (only the id is needed)
+            existing_user_id = db.session.execute(
+                select(User.id).where(User.email == contact_email.lower())
+            ).scalar()
+            if existing_user_id:
+                customer_id = existing_user_id
             else:
                 # For test mode, create a temporary user or use None
                 # This allows testing payments without full user registration
@@ -1420,12 +1558,11 @@ def create_order():
                     # In test mode, we can create orders without users
                     customer_id = None
                 else:
-                    # Create new user
+                    # Create new user (saved in the same transaction as the order)
                     import secrets
-                    import string
                     
-                    # Generate random password
-                    password = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(8))
+                    # Generate random password (8 url-safe chars from a single urandom call)
+                    password = secrets.token_urlsafe(6)
                     
                     new_user = User(
                         email=contact_email,
@@ -1434,76 +1571,65 @@ def create_order():
                         is_active=True
                     )
                     new_user.set_password(password)
-                    db.session.add(new_user)
-                    db.session.flush()  # Get the ID
-                    customer_id = new_user.id
-                    
-                    # Send credentials email
-                    try:
-                        from app.utils.email import send_user_credentials_email
-                        send_user_credentials_email(new_user, password)
-                    except Exception as e:
-                        logger.error(f'Error sending credentials email: {str(e)}')
-                    
-                    # Auto-login the new user
-                    from flask_login import login_user
-                    login_user(new_user, remember=False)
-        
-        # Create order
-        order = Order(
-            order_number=Order.generate_order_number(),
-            generated_order_number=Order.generate_human_order_number(),
-            customer_id=customer_id,
-            event_id=cart_items[0]['athlete'].category.event_id,
-            category_id=cart_items[0]['athlete'].category_id,
-            athlete_id=cart_items[0]['athlete'].id,
-            video_types=video_types,
-            total_amount=total_amount,
-            status='checkout_initiated',
-            contact_email=contact_email,
-            contact_phone=contact_phone,
-            contact_first_name=contact_first_name,
-            contact_last_name=contact_last_name,
-            comment=comment
-        )
         
-        db.session.add(order)
+        # Order fields (built once; every attempt gets a fresh Order instance)
+        order_kwargs = {
+            'order_number': Order.generate_order_number(),
+            'generated_order_number': Order.generate_human_order_number(),
+            'customer_id': customer_id,
+            'event_id': first_event_id,
+            'category_id': first_athlete.category_id,
+            'athlete_id': first_athlete.id,
+            'video_types': video_types,
+            'total_amount': total_amount,
+            'status': 'checkout_initiated',
+            'contact_email': contact_email,
+            'contact_phone': contact_phone,
+            'contact_first_name': contact_first_name,
+            'contact_last_name': contact_last_name,
+            'comment': comment,
+        }
         
-        # Commit with retry logic for SQLite database locked errors
-        import time
-        import random
-        from sqlalchemy.exc import OperationalError
+        # ✅ Одна транзакция записи (BEGIN IMMEDIATE на SQLite): удаление старого заказа + пользователь + заказ
+        # ✅ Retry логика для SQLite "database is locked" (изменения применяются заново после rollback)
+        @sqlite_retry(max_attempts=2)
+        def _persist_order():
+            with sqlite_write_tx():
+                if stale_order_delete is not None:
+                    db.session.execute(stale_order_delete)
+                # Create order
+                new_order = Order(**order_kwargs)
+                if new_user is not None:
+                    db.session.add(new_user)
+                    db.session.flush()  # Get the ID
+                    new_order.customer_id = new_user.id
+                db.session.add(new_order)
+            return new_order
         
-        max_retries = 5
-        retry_delay = 0.1
+        try:
+            order = _persist_order()
+        except OperationalError as e:
+            logger.error(f'Error creating order via API: {str(e)}')
+            return jsonify({
+                'success': False, 
+                'error': 'База данных временно недоступна. Попробуйте еще раз через несколько секунд.'
+            }), 503
+        except Exception as e:
+            return _internal_error_response(e, 'Error creating order via API', 'Ошибка создания заказа', exc_info=True)
         
-        for attempt in range(max_retries):
+        if new_user is not None:
+            # Send credentials email
             try:
-                db.session.commit()
-                break  # Success
-            except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
-                    db.session.rollback()
-                    wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                    logger.warning(f'Database locked in API create_order, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
-                    time.sleep(wait_time)
-                    db.session.add(order)  # Re-add after rollback
-                else:
-                    db.session.rollback()
-                    logger.error(f'Error creating order via API after {attempt + 1} attempts: {str(e)}')
-                    return jsonify({
-                        'success': False, 
-                        'error': 'База данных временно недоступна. Попробуйте еще раз через несколько секунд.'
-                    }), 503
+                from app.utils.email import send_user_credentials_email
+                send_user_credentials_email(new_user, password)
             except Exception as e:
-                db.session.rollback()
-                logger.error(f'Error creating order via API: {str(e)}', exc_info=True)
-                return jsonify({
-                    'success': False, 
-                    'error': _mask_internal_error(e, 'Ошибка создания заказа')
-                }), 500
+                logger.error(f'Error sending credentials email: {str(e)}')
+            
+            # Auto-login the new user
+            from flask_login import login_user
+            login_user(new_user, remember=False)
         
-        # Store order ID in session
+        # Store order ID in session (single session write per checkout)
         session['pending_order_id'] = order.id
         
         return jsonify({
@@ -1513,90 +1639,113 @@ def create_order():
         })
         
     except Exception as e:
-        logger.error(f'Create order error: {str(e)}', exc_info=True)
-        db.session.rollback()
-        return jsonify({'success': False, 'error': _mask_internal_error(e, 'Ошибка создания заказа')}), 500
+        return _internal_error_response(e, 'Create order error', 'Ошибка создания заказа', exc_info=True)
 
 @bp.route('/order/<int:order_id>/update-comments', methods=['POST'])
 @login_required
 @role_required('OPERATOR', 'ADMIN', 'MOM')
 def update_order_comments(order_id):
     """Update order comments and refund status"""
+    # ✅ Загрузка по PK через identity map; вне try, чтобы 404 не превращался в 500
+    # ✅ Нужны только поля для выбора статуса и проверки no-op; запись идет узким UPDATE ниже
+    order = db.session.get(
+        Order, order_id,
+        options=[load_only(Order.video_links, Order.operator_id, Order.status,
+                           Order.operator_comment, Order.refund_reason)]
+    ) or abort(404)
+    
     try:
-        import time
-        import random
-        from sqlalchemy.exc import OperationalError
-        
-        order = Order.query.get_or_404(order_id)
-        
-        data = request.get_json()
+        data = _json_body()
         operator_comment = data.get('operator_comment', '')
         partial_refund = data.get('partial_refund', False)
         refund_reason = data.get('refund_reason', '')
         
-        # Update order comments
-        order.operator_comment = operator_comment
+        # ✅ Данные запроса для аудита - один раз; фоновая задача не имеет доступа к request
+        user_id = current_user.id
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
         
-        # Update refund status and reason
         old_status = order.status
+        
+        # ✅ Целевой статус вычисляется один раз: при retry повторяется только UPDATE
+        new_status = old_status
         if partial_refund:
-            order.status = 'refund_required'
-            order.refund_reason = refund_reason
+            new_status = 'refund_required'
+            new_refund_reason = refund_reason
         else:
             # ✅ Если снимаем флаг частичного возврата, вернуться к правильному статусу
-            if order.status == 'refund_required':
+            if old_status == 'refund_required':
                 # ✅ Вернуться к статусу, который был до refund_required
                 if order.video_links:
-                    order.status = 'links_sent'  # ✅ Ссылки уже были отправлены
+                    new_status = 'links_sent'  # ✅ Ссылки уже были отправлены
                 elif order.operator_id:
-                    order.status = 'processing'  # ✅ В обработке у оператора
+                    new_status = 'processing'  # ✅ В обработке у оператора
                 else:
-                    order.status = 'paid'  # ✅ Оплачен, но еще не взят оператором
-            order.refund_reason = None
+                    new_status = 'paid'  # ✅ Оплачен, но еще не взят оператором
+            new_refund_reason = None
+        
+        # ✅ Ничего не изменилось (повторный клик / повтор запроса) - без транзакции записи и аудита
+        if (
+            new_status == old_status
+            and (order.operator_comment or '') == (operator_comment or '')
+            and (order.refund_reason or '') == (new_refund_reason or '')
+        ):
+            return jsonify({
+                'success': True,
+                'message': 'Комментарии обновлены успешно'
+            })
         
-        # ✅ Retry логика для обработки "database is locked"
-        max_retries = 5
-        retry_delay = 0.1  # Start with 100ms
+        # ✅ Retry логика для обработки "database is locked" (UPDATE применяется заново после rollback)
+        # ✅ BEGIN IMMEDIATE на SQLite: блокировка записи берется сразу, а не при COMMIT
+        @sqlite_retry(max_attempts=2)
+        def _persist_comments():
+            with sqlite_write_tx():
+                # ✅ Узкий UPDATE без unit-of-work flush; статус проверяется, т.к. решение принято до транзакции
+                result = db.session.execute(
+                    update(Order)
+                    .where(Order.id == order_id, Order.status == old_status)
+                    .values(
+                        operator_comment=operator_comment,
+                        status=new_status,
+                        refund_reason=new_refund_reason
+                    ),
+                    execution_options={'synchronize_session': False}
+                )
+                # ✅ Аудит в той же транзакции, что и UPDATE заказа (один COMMIT)
+                if result.rowcount:
+                    AuditLog.create_log(
+                        user_id=user_id,
+                        action='ORDER_COMMENTS_UPDATE',
+                        resource_type='Order',
+                        resource_id=str(order_id),
+                        details={
+                            'operator_comment': operator_comment,
+                            'partial_refund': partial_refund,
+                            'refund_reason': refund_reason,
+                            'old_status': old_status,
+                            'new_status': new_status
+                        },
+                        ip_address=ip_address,
+                        user_agent=user_agent,
+                        bulk=True
+                    )
+            return result.rowcount
         
-        for attempt in range(max_retries):
-            try:
-                db.session.commit()
-                break  # Success, exit retry loop
-            except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
-                    db.session.rollback()
-                    wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                    logger.warning(f'Database locked in update_order_comments, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
-                    time.sleep(wait_time)
-                    # Re-apply changes after rollback
-                    order.operator_comment = operator_comment
-                    if partial_refund:
-                        order.status = 'refund_required'
-                        order.refund_reason = refund_reason
-                    else:
-                        if order.status == 'refund_required':
-                            if order.video_links:
-                                order.status = 'links_sent'
-                            elif order.operator_id:
-                                order.status = 'processing'
-                            else:
-                                order.status = 'paid'
-                        order.refund_reason = None
-                else:
-                    db.session.rollback()
-                    logger.error(f'Error updating order comments after {attempt + 1} attempts: {str(e)}')
-                    raise
-        
-        # Log action
-        AuditLog.create_log(
-            user_id=current_user.id,
-            action='ORDER_COMMENTS_UPDATE',
-            resource_type='Order',
-            resource_id=str(order.id),
-            details={'operator_comment': operator_comment, 'partial_refund': partial_refund, 'refund_reason': refund_reason, 'old_status': old_status, 'new_status': order.status},
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+        if not _persist_comments():
+            return jsonify({
+                'success': False,
+                'error': 'Статус заказа изменился, обновите страницу и повторите'
+            }), 409
+        
+        # ✅ Системное сообщение в чат пишет фоновый воркер, ответ ждет только UPDATE и аудит
+        if new_status != old_status:
+            enqueue_notification(
+                post_status_change_message_task,
+                order_id,
+                new_status,
+                operator_comment,
+                user_id
+            )
         
         return jsonify({
             'success': True,
@@ -1604,57 +1753,7 @@ def update_order_comments(order_id):
         })
         
     except Exception as e:
-        db.session.rollback()
-        logger.error(f'Update order comments error: {str(e)}')
-        return jsonify({
-            'success': False,
-            'error': _mask_internal_error(e, 'Не удалось обновить комментарии к заказу')
-        }), 500
-
-def _add_status_change_message(order_id, new_status, comment, user_id):
-    """Add system message to chat when status changes"""
-    try:
-        from app.models import OrderChat, ChatMessage
-        from app.utils.order_status import get_status_label
-        
-        # Create or get chat
-        chat = OrderChat.query.filter_by(order_id=order_id).first()
-        if not chat:
-            chat = OrderChat(order_id=order_id)
-            db.session.add(chat)
-            db.session.commit()
-        
-        # Create status message
-        status_messages = {
-            'checkout_initiated': 'Заказ возвращен к оформлению',
-            'awaiting_payment': 'Заказ ожидает оплаты клиентом',
-            'paid': 'Оплата зафиксирована, заказ ждет оператора',
-            'processing': 'Заказ взят в обработку',
-            'awaiting_info': 'Требуется дополнительная информация от клиента',
-            'links_sent': 'Ссылки на видео отправлены клиенту',
-            'completed': 'Заказ завершен',
-            'completed_partial_refund': 'Заказ завершен с частичным возвратом',
-            'refund_required': 'По заказу требуется возврат',
-            'cancelled_unpaid': 'Заказ отменен (не оплачен)',
-            'cancelled_manual': 'Заказ отменен вручную',
-            'refunded_partial': 'Оформлен частичный возврат',
-            'refunded_full': 'Оформлен полный возврат',
-        }
-        
-        message_text = status_messages.get(new_status, f'Статус изменен на {get_status_label(new_status)}')
-        if comment:
-            message_text += f'. Комментарий: {comment}'
-        
-        system_message = ChatMessage(
-            chat_id=chat.id,
-            sender_id=user_id,
-            message=message_text,
-            message_type='system'
-        )
-        db.session.add(system_message)
-        db.session.commit()
-    except Exception as e:
-        logger.error(f"Failed to add system message: {e}")
+        return _internal_error_response(e, 'Update order comments error', 'Не удалось обновить комментарии к заказу')
 
 # Register CloudPayments webhook routes
 register_cloudpayments_routes(bp)
\ No newline at end of file
@@ -2,14 +2,28 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
 from app.models import User
+from functools import lru_cache
 import re
 
 try:
     import phonenumbers
     PHONENUMBERS_AVAILABLE = True
+    # ✅ Метаданные региона RU загружаются при импорте, а не на первом запросе
+    phonenumbers.parse('+79000000000', 'RU')
 except ImportError:
     PHONENUMBERS_AVAILABLE = False
 
+@lru_cache(maxsize=4096)
+def phone_to_e164(raw_phone):
+    """Parse a phone number (region RU) and return it in E164, or None if it is not valid"""
+    try:
+        parsed_number = phonenumbers.parse(raw_phone, 'RU')
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(parsed_number):
+        return None
+    return phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
+
 def validate_password_strength(form, field):
     """Validate password strength: minimum 8 characters, letters and numbers"""
     password = field.data
@@ -53,11 +67,7 @@ class LoginForm(FlaskForm):
             # Validate phone format
             if not PHONENUMBERS_AVAILABLE:
                 raise ValidationError('Библиотека phonenumbers не установлена. Установите: pip install phonenumbers')
-            try:
-                parsed_phone = phonenumbers.parse(field.data, "RU")
-                if not phonenumbers.is_valid_number(parsed_phone):
-                    raise ValidationError('Некорректный номер телефона')
-            except:
+            if phone_to_e164(field.data) is None:
                 raise ValidationError('Некорректный номер телефона')
 
 class RegistrationForm(FlaskForm):
@@ -76,15 +86,11 @@ class RegistrationForm(FlaskForm):
     
     def validate_phone(self, phone):
         if phone.data:
-            try:
-                # Parse and validate phone number
-                parsed_number = phonenumbers.parse(phone.data, 'RU')
-                if not phonenumbers.is_valid_number(parsed_number):
-                    raise ValidationError('Неверный формат номера телефона')
-                # Normalize phone number
-                self.phone.data = phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
-            except phonenumbers.NumberParseException:
+            # Parse, validate and normalize phone number
+            normalized_phone = phone_to_e164(phone.data)
+            if normalized_phone is None:
                 raise ValidationError('Неверный формат номера телефона')
+            self.phone.data = normalized_phone
 
 class PasswordResetForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
@@ -117,10 +123,7 @@ class UserEditForm(FlaskForm):
     
     def validate_phone(self, phone):
         if phone.data:
-            try:
-                parsed_number = phonenumbers.parse(phone.data, 'RU')
-                if not phonenumbers.is_valid_number(parsed_number):
-                    raise ValidationError('Неверный формат номера телефона')
-                self.phone.data = phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
-            except phonenumbers.NumberParseException:
+            normalized_phone = phone_to_e164(phone.data)
+            if normalized_phone is None:
                 raise ValidationError('Неверный формат номера телефона')
+            self.phone.data = normalized_phone
@@ -1,12 +1,24 @@
 from flask import render_template, redirect, url_for, flash, request
+from flask_limiter.util import get_remote_address
 from flask_login import login_user, logout_user, current_user, login_required
 from app import db, limiter
 from app.auth import bp
 from app.auth.forms import (LoginForm, RegistrationForm, PasswordResetForm, 
-                           PasswordResetConfirmForm, ChangePasswordForm)
-from app.models import User, AuditLog
+                           PasswordResetConfirmForm, ChangePasswordForm,
+                           PHONENUMBERS_AVAILABLE, phone_to_e164)
+from app.models import User
+from app.tasks.audit import enqueue_audit_log
+from app.utils.datetime_utils import moscow_now_naive
 from app.utils.decorators import role_required
-from app.utils.email import send_password_reset_email, send_user_credentials_email, send_new_password_email
+from app.tasks.notifications import enqueue_notification, reset_password_task
+from app.utils.email import send_password_reset_email, send_user_credentials_email
+
+LAST_LOGIN_UPDATE_INTERVAL = 60  # seconds; last_login is kept to the minute
+
+def _reset_password_email_key():
+    """Rate-limit key for password resets: the target email (falls back to the client IP)"""
+    email = (request.form.get('email') or '').strip().lower()
+    return f'reset_password:{email}' if email else get_remote_address()
 
 @bp.route('/login', methods=['GET', 'POST'])
 @limiter.limit("5 per minute")  # ✅ Максимум 5 попыток входа в минуту
@@ -20,43 +32,37 @@ def login():
         
         # Determine if it's email or phone and search accordingly
         user = None
-        login_method = None
         
         if '@' in login_field:
             # Search by email
             user = User.query.filter_by(email=login_field.lower()).first()
-            login_method = 'email'
         else:
-            # Search by phone
-            try:
-                import phonenumbers
-                parsed_phone = phonenumbers.parse(login_field, "RU")
-                if phonenumbers.is_valid_number(parsed_phone):
-                    formatted_phone = phonenumbers.format_number(parsed_phone, phonenumbers.PhoneNumberFormat.E164)
-                    user = User.query.filter_by(phone=formatted_phone).first()
-                    login_method = 'phone'
-                else:
-                    flash('Некорректный номер телефона', 'error')
-                    return render_template('auth/login.html', form=form)
-            except Exception as e:
-                # Если не удалось распарсить телефон, пытаемся найти по исходному значению
+            # Search by phone (✅ нормализация кешируется, phonenumbers импортирован на уровне модуля)
+            formatted_phone = phone_to_e164(login_field) if PHONENUMBERS_AVAILABLE else None
+            if formatted_phone:
+                user = User.query.filter_by(phone=formatted_phone).first()
+            else:
+                # Если не удалось распознать телефон, пытаемся найти по исходному значению
                 user = User.query.filter_by(phone=login_field).first()
-                if not user:
-                    flash('Некорректный формат email или номера телефона', 'error')
-                    return render_template('auth/login.html', form=form)
-                login_method = 'phone'
         
-        if user and user.check_password(form.password.data):
+        # ✅ Для несуществующего пользователя хеш тоже проверяется - время ответа не выдает, есть ли аккаунт
+        if user:
+            password_ok = user.check_password(form.password.data)
+        else:
+            password_ok = User.check_password_dummy(form.password.data)
+        
+        if password_ok:
             if not user.is_active:
                 flash('Ваш аккаунт деактивирован. Обратитесь к администратору.', 'error')
                 return render_template('auth/login.html', form=form)
             
             login_user(user, remember=form.remember_me.data)
             
-            # Update last login
-            from app.utils.datetime_utils import moscow_now_naive
-            user.last_login = moscow_now_naive()
-            db.session.commit()
+            # Update last login (✅ повторные входы в течение минуты не пишут в БД)
+            now = moscow_now_naive()
+            if not user.last_login or (now - user.last_login).total_seconds() > LAST_LOGIN_UPDATE_INTERVAL:
+                user.last_login = now
+                db.session.commit()
             
             # Redirect to appropriate dashboard
             next_page = request.args.get('next')
@@ -72,10 +78,12 @@ def login():
                 else:
                     next_page = url_for('main.index')
             
-            # Log successful login
-            AuditLog.log_user_action(
+            # Log successful login (буферизованная запись, вне транзакции запроса)
+            enqueue_audit_log(
                 user_id=user.id,
                 action='LOGIN',
+                resource_type='user',
+                resource_id=str(user.id),
                 ip_address=request.remote_addr,
                 user_agent=request.headers.get('User-Agent'),
                 details={'remember_me': form.remember_me.data}
@@ -84,17 +92,8 @@ def login():
             flash(f'Добро пожаловать, {user.full_name}!', 'success')
             return redirect(next_page)
         else:
-            if user:
-                # Пользователь найден, но пароль неверный
-                flash('Неверный пароль', 'error')
-            else:
-                # Пользователь не найден
-                if login_method == 'email':
-                    flash('Пользователь с таким email не найден', 'error')
-                elif login_method == 'phone':
-                    flash('Пользователь с таким номером телефона не найден', 'error')
-                else:
-                    flash('Неверный email/телефон или пароль', 'error')
+            # ✅ Одно сообщение для неизвестного пользователя и неверного пароля (без перебора аккаунтов)
+            flash('Неверный email/телефон или пароль', 'error')
     
     return render_template('auth/login.html', form=form)
 
@@ -102,9 +101,11 @@ def login():
 @login_required
 def logout():
     # Log logout
-    AuditLog.log_user_action(
+    enqueue_audit_log(
         user_id=current_user.id,
         action='LOGOUT',
+        resource_type='user',
+        resource_id=str(current_user.id),
         ip_address=request.remote_addr,
         user_agent=request.headers.get('User-Agent')
     )
@@ -114,6 +115,7 @@ def logout():
     return redirect(url_for('main.index'))
 
 @bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit("5 per hour", methods=['POST'])  # ✅ bcrypt + COMMIT на каждую попытку
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -131,7 +133,7 @@ def register():
         db.session.commit()
         
         # Log registration
-        AuditLog.create_log(
+        enqueue_audit_log(
             user_id=user.id,
             action='REGISTER',
             ip_address=request.remote_addr,
@@ -144,6 +146,8 @@ def register():
     return render_template('auth/register.html', form=form)
 
 @bp.route('/reset_password', methods=['GET', 'POST'])
+@limiter.limit("10 per hour", methods=['POST'])  # ✅ С одного IP
+@limiter.limit("3 per hour;10 per day", methods=['POST'], key_func=_reset_password_email_key)  # ✅ На один email (письма и смена пароля)
 def reset_password():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -152,16 +156,14 @@ def reset_password():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data.lower()).first()
         if user:
-            # Generate new password
-            new_password = User.generate_password()
-            user.set_password(new_password)
-            db.session.commit()
-            
-            # Send new password via email
-            send_new_password_email(user, new_password)
+            # ✅ Пароль генерируется, сохраняется и отправляется в фоновом потоке:
+            # ✅ ответ не ждет bcrypt и SMTP, а сам пароль не проходит через очередь
+            if not enqueue_notification(reset_password_task, user.id):
+                flash('Не удалось сбросить пароль. Попробуйте позже.', 'error')
+                return redirect(url_for('auth.reset_password'))
             
             # Log password reset
-            AuditLog.create_log(
+            enqueue_audit_log(
                 user_id=user.id,
                 action='PASSWORD_RESET',
                 ip_address=request.remote_addr,
@@ -191,7 +193,7 @@ def reset_password_confirm(token):
         db.session.commit()
         
         # Log password reset
-        AuditLog.create_log(
+        enqueue_audit_log(
             user_id=user.id,
             action='PASSWORD_RESET',
             ip_address=request.remote_addr,
@@ -216,7 +218,7 @@ def change_password():
         db.session.commit()
         
         # Log password change
-        AuditLog.create_log(
+        enqueue_audit_log(
             user_id=current_user.id,
             action='PASSWORD_CHANGE',
             ip_address=request.remote_addr,
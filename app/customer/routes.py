@@ -2,11 +2,19 @@ from flask import render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required, current_user
 from app import db
 from app.customer import bp
-from app.models import Order, Payment, VideoType
+from app.models import Order, Payment
 from app.utils.decorators import customer_required
-from sqlalchemy import desc
+from sqlalchemy import bindparam, case, desc, func, select
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta
 from app.utils.order_status import expand_status_filter, get_status_filter_choices
+from app.utils.video_types import get_video_types_dict
+
+# ✅ Запрос счетчиков строится один раз при импорте: на каждый запрос только подставляется customer_id
+_DASHBOARD_COUNTS_STMT = select(
+    func.count(case((Order.status.in_(['checkout_initiated', 'awaiting_payment']), 1), else_=None)).label('pending_orders'),
+    func.count(case((Order.status.in_(['paid', 'processing', 'awaiting_info', 'links_sent']), 1), else_=None)).label('processing_orders')
+).where(Order.customer_id == bindparam('customer_id'))
 
 @bp.route('/dashboard')
 @login_required
@@ -14,25 +22,22 @@ from app.utils.order_status import expand_status_filter, get_status_filter_choic
 def dashboard():
     """Customer dashboard"""
     
-    # Get user's orders
-    orders = Order.query.filter_by(customer_id=current_user.id)\
-                       .order_by(desc(Order.created_at)).limit(10).all()
+    # Get user's orders (✅ event/athlete подгружаются сразу - шаблон читает их для каждой строки)
+    orders = Order.query.options(
+        joinedload(Order.event),
+        joinedload(Order.athlete)
+    ).filter_by(customer_id=current_user.id)\
+     .order_by(desc(Order.created_at)).limit(10).all()
     
-    # Get statistics
+    # Get statistics (✅ оба счетчика одним запросом с условной агрегацией)
+    counts = db.session.execute(_DASHBOARD_COUNTS_STMT, {'customer_id': current_user.id}).one()
     stats = {
-        'pending_orders': Order.query.filter(
-            Order.customer_id == current_user.id,
-            Order.status.in_(['checkout_initiated', 'awaiting_payment'])
-        ).count(),
-        'processing_orders': Order.query.filter(
-            Order.customer_id == current_user.id,
-            Order.status.in_(['paid', 'processing', 'awaiting_info', 'links_sent'])
-        ).count(),
+        'pending_orders': counts.pending_orders,
+        'processing_orders': counts.processing_orders,
     }
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types} if video_types else {}
+    video_types_dict = get_video_types_dict()
     
     return render_template('customer/dashboard.html', orders=orders, stats=stats, video_types_dict=video_types_dict)
 
@@ -44,7 +49,10 @@ def orders():
     page = request.args.get('page', 1, type=int)
     status_filter = request.args.get('status', '', type=str)
     
-    query = Order.query.filter_by(customer_id=current_user.id)
+    query = Order.query.options(
+        joinedload(Order.event),
+        joinedload(Order.athlete)
+    ).filter_by(customer_id=current_user.id)
     
     if status_filter:
         normalized_statuses = expand_status_filter(status_filter) or [status_filter]
@@ -55,8 +63,7 @@ def orders():
     )
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types} if video_types else {}
+    video_types_dict = get_video_types_dict()
     
     status_options = [
         meta for meta in get_status_filter_choices()
@@ -76,15 +83,20 @@ def orders():
 @customer_required
 def order_detail(order_id):
     """Order detail page"""
-    # Find order by customer_id OR by contact_email (for guest users)
-    order = Order.query.filter(
-        (Order.id == order_id) & 
-        ((Order.customer_id == current_user.id) | (Order.contact_email == current_user.email))
-    ).first_or_404()
+    # Find order by customer_id, then by contact_email (for guest users)
+    # ✅ Основной путь - поиск по первичному ключу без OR; email проверяется только для гостевых заказов
+    user = current_user._get_current_object()
+    query = Order.query.options(
+        joinedload(Order.event),
+        joinedload(Order.category),
+        joinedload(Order.athlete)
+    )
+    order = query.filter(Order.id == order_id, Order.customer_id == user.id).first()
+    if not order:
+        order = query.filter(Order.id == order_id, Order.contact_email == user.email.lower()).first_or_404()
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types} if video_types else {}
+    video_types_dict = get_video_types_dict()
     
     return render_template('customer/order_detail.html', order=order, video_types_dict=video_types_dict)
 
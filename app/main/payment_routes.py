@@ -7,8 +7,14 @@ from flask import request, redirect, url_for, flash, render_template, session, c
 from flask_login import current_user
 from app import db
 from app.models import Order, User, Athlete, VideoType
-from app.utils.cloudpayments import CloudPaymentsAPI
-from app.utils.email import send_order_confirmation_email
+from app.utils.cloudpayments import get_cloudpayments_api
+from app.tasks.notifications import enqueue_notification, send_order_confirmation_task
+from app.utils.db_retry import sqlite_retry, sqlite_write_tx
+from app.utils.decorators import STAFF_ROLES
+from app.utils.video_types import get_video_types_map
+from sqlalchemy import delete, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 import logging
 
@@ -61,13 +67,16 @@ def register_payment_routes(bp):
             contact_phone = normalized_phone
             
             # Clean up any existing pending orders from session
+            # ✅ Один условный DELETE вместо SELECT + проверки статуса + DELETE; коммитится вместе с новым заказом
+            # ✅ pending_order_id не трогаем до коммита: если валидация или запись не пройдут,
+            # ✅ сессия по-прежнему указывает на старый заказ; ключ перезаписывается ниже
             pending_order_id = session.get('pending_order_id')
+            stale_order_delete = None
             if pending_order_id:
-                old_order = Order.query.get(pending_order_id)
-                if old_order and old_order.status == 'awaiting_payment':
-                    db.session.delete(old_order)
-                    db.session.commit()
-                session.pop('pending_order_id', None)
+                stale_order_delete = delete(Order).where(
+                    Order.id == pending_order_id,
+                    Order.status == 'awaiting_payment'
+                )
             
             # ✅ Process all items in cart and aggregate into single order
             cart_items = []
@@ -77,34 +86,51 @@ def register_payment_routes(bp):
             # Collect all athletes and video types from cart
             athletes_in_cart = set()
             
+            parsed_cart = []
             for item_id, quantity in cart.items():
                 try:
                     athlete_id, video_type_id = map(int, item_id.split('_'))
-                    athlete = Athlete.query.get(athlete_id)
-                    video_type = VideoType.query.get(video_type_id)
-                    
-                    if athlete and video_type:
-                        item_total = video_type.price * quantity
-                        total_amount += item_total
-                        
-                        cart_items.append({
-                            'athlete': athlete,
-                            'video_type': video_type,
-                            'quantity': quantity,
-                            'total': item_total
-                        })
-                        
-                        athletes_in_cart.add(athlete_id)
-                        
-                        # Add video type to order (multiple times if quantity > 1)
-                        for _ in range(quantity):
-                            all_video_types.append(video_type_id)
-                    else:
-                        flash(f'Товар {item_id} не найден', 'error')
-                        return redirect(url_for('main.checkout'))
                 except (ValueError, AttributeError):
                     flash(f'Ошибка в данных товара {item_id}', 'error')
                     return redirect(url_for('main.checkout'))
+                parsed_cart.append((item_id, athlete_id, video_type_id, quantity))
+            
+            # ✅ Спортсмены и типы видео загружаются двумя IN-запросами, а не по запросу на позицию
+            athletes_by_id = {
+                athlete.id: athlete
+                for athlete in Athlete.query.options(joinedload(Athlete.category)).filter(
+                    Athlete.id.in_({athlete_id for _, athlete_id, _, _ in parsed_cart})
+                )
+            }
+            video_types_by_id = {
+                video_type.id: video_type
+                for video_type in VideoType.query.filter(
+                    VideoType.id.in_({video_type_id for _, _, video_type_id, _ in parsed_cart})
+                )
+            }
+            
+            for item_id, athlete_id, video_type_id, quantity in parsed_cart:
+                athlete = athletes_by_id.get(athlete_id)
+                video_type = video_types_by_id.get(video_type_id)
+                
+                if athlete and video_type:
+                    item_total = video_type.price * quantity
+                    total_amount += item_total
+                    
+                    cart_items.append({
+                        'athlete': athlete,
+                        'video_type': video_type,
+                        'quantity': quantity,
+                        'total': item_total
+                    })
+                    
+                    athletes_in_cart.add(athlete_id)
+                    
+                    # Add video type to order (multiple times if quantity > 1)
+                    all_video_types.extend([video_type_id] * quantity)
+                else:
+                    flash(f'Товар {item_id} не найден', 'error')
+                    return redirect(url_for('main.checkout'))
             
             if not cart_items:
                 flash('Корзина пуста или содержит некорректные товары', 'error')
@@ -131,106 +157,89 @@ def register_payment_routes(bp):
             contact_first_name = request.form.get('contact_first_name', '').strip()
             contact_last_name = request.form.get('contact_last_name', '').strip()
             
-            # ✅ ВСЕ ОПЕРАЦИИ В ОДНОЙ ТРАНЗАКЦИИ
-            try:
-                # Get or create customer user
-                customer_id = None
-                if current_user.is_authenticated:
-                    customer_id = current_user.id
-                else:
-                    # Check if user already exists
-                    existing_user = User.query.filter_by(email=contact_email).first()
-                    if existing_user:
-                        customer_id = existing_user.id
-                    else:
-                        # Create new user
-                        import secrets
-                        password = secrets.token_urlsafe(12)
-                        
-                        new_user = User(
-                            email=contact_email,
-                            full_name=f"{contact_first_name} {contact_last_name}".strip(),
-                            phone=contact_phone,
-                            role='CUSTOMER',
-                            is_active=True
-                        )
-                        new_user.set_password(password)
-                        
+            # Get or create customer user
+            customer_id = None
+            new_user = None
+            if current_user.is_authenticated:
+                customer_id = current_user.id
+            else:
+                # Check if user already exists (only the id is needed)
+                customer_id = db.session.execute(
+                    select(User.id).where(User.email == contact_email.lower())
+                ).scalar()
+                if not customer_id:
+                    # Create new user (saved in the same transaction as the order)
+                    import secrets
+                    password = secrets.token_urlsafe(12)
+                    
+                    new_user = User(
+                        email=contact_email,
+                        full_name=f"{contact_first_name} {contact_last_name}".strip(),
+                        phone=contact_phone,
+                        role='CUSTOMER',
+                        is_active=True
+                    )
+                    new_user.set_password(password)
+            
+            # Create ONE order with all items from cart (for same athlete)
+            first_athlete = cart_items[0]['athlete']
+            
+            # Order fields (built once; every attempt gets a fresh Order instance)
+            order_kwargs = {
+                'order_number': Order.generate_order_number(),
+                'generated_order_number': Order.generate_human_order_number(),
+                'customer_id': customer_id,
+                'event_id': first_athlete.category.event_id,
+                'category_id': first_athlete.category_id,
+                'athlete_id': first_athlete.id,
+                'video_types': all_video_types,  # All video types from cart
+                'total_amount': total_amount,  # Total amount for all items
+                'status': 'awaiting_payment',
+                'contact_email': contact_email,
+                'contact_phone': contact_phone,
+                'contact_first_name': contact_first_name,
+                'contact_last_name': contact_last_name,
+                'comment': comment,
+            }
+            
+            # ✅ ВСЕ ОПЕРАЦИИ В ОДНОЙ ТРАНЗАКЦИИ (user + cleanup + order), один COMMIT
+            # ✅ Retry для SQLite "database is locked": после rollback все изменения применяются заново
+            @sqlite_retry()
+            def _persist_order():
+                with sqlite_write_tx():
+                    if stale_order_delete is not None:
+                        db.session.execute(stale_order_delete)
+                    new_order = Order(**order_kwargs)
+                    if new_user is not None:
                         db.session.add(new_user)
                         db.session.flush()  # Get the ID without committing
-                        customer_id = new_user.id
-                
-                # Clean up any existing pending orders for this customer
-                existing_pending_orders = Order.query.filter_by(
-                    customer_id=customer_id,
-                    status='awaiting_payment'
-                ).all()
-                
-                for old_order in existing_pending_orders:
-                    db.session.delete(old_order)
-                
-                # Create ONE order with all items from cart (for same athlete)
-                first_athlete = cart_items[0]['athlete']
-                
-                order = Order(
-                    order_number=Order.generate_order_number(),
-                    generated_order_number=Order.generate_human_order_number(),
-                    customer_id=customer_id,
-                    event_id=first_athlete.category.event_id,
-                    category_id=first_athlete.category_id,
-                    athlete_id=first_athlete.id,
-                    video_types=all_video_types,  # All video types from cart
-                    total_amount=total_amount,  # Total amount for all items
-                    status='awaiting_payment',
-                    contact_email=contact_email,
-                    contact_phone=contact_phone,
-                    contact_first_name=contact_first_name,
-                    contact_last_name=contact_last_name,
-                    comment=comment
-                )
-                db.session.add(order)
-                
-                # ✅ ОДИН КОММИТ ДЛЯ ВСЕХ ОПЕРАЦИЙ (user + cleanup + order)
-                # Use retry logic for SQLite database locked errors
-                import time
-                import random
-                from sqlalchemy.exc import OperationalError
-                
-                max_retries = 5
-                retry_delay = 0.1  # Start with 100ms
-                
-                for attempt in range(max_retries):
-                    try:
-                        db.session.commit()  # Save all changes atomically
-                        break  # Success, exit retry loop
-                    except OperationalError as e:
-                        if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
-                            db.session.rollback()
-                            wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
-                            logger.warning(f'Database locked, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
-                            time.sleep(wait_time)
-                        else:
-                            db.session.rollback()
-                            logger.error(f'Error creating order after {attempt + 1} attempts: {str(e)}')
-                            flash('Ошибка создания заказа. База данных временно недоступна. Попробуйте еще раз через несколько секунд.', 'error')
-                            return redirect(url_for('main.checkout'))
-                    except Exception as e:
-                        db.session.rollback()
-                        logger.error(f'Error creating order: {str(e)}', exc_info=True)
-                        flash('Ошибка создания заказа. Попробуйте еще раз.', 'error')
-                        return redirect(url_for('main.checkout'))
-                
+                        new_order.customer_id = new_user.id
+                    else:
+                        # Clean up any existing pending orders for this customer (✅ один DELETE без загрузки строк)
+                        db.session.execute(delete(Order).where(
+                            Order.customer_id == customer_id,
+                            Order.status == 'awaiting_payment'
+                        ))
+                    db.session.add(new_order)
+                return new_order
+            
+            try:
+                order = _persist_order()
+            except OperationalError as e:
+                logger.error(f'Error creating order: {str(e)}')
+                flash('Ошибка создания заказа. База данных временно недоступна. Попробуйте еще раз через несколько секунд.', 'error')
+                return redirect(url_for('main.checkout'))
             except Exception as e:
                 db.session.rollback()
                 logger.error(f'Error in order creation transaction: {str(e)}', exc_info=True)
                 flash('Ошибка создания заказа. Попробуйте еще раз.', 'error')
                 return redirect(url_for('main.checkout'))
             
-            # Store order ID in session for success/failure handling
+            # Store order ID in session for success/failure handling (старый заказ удален тем же коммитом)
             session['pending_order_id'] = order.id
             
             # Create CloudPayments widget URL using order object
-            cp_api = CloudPaymentsAPI()
+            cp_api = get_cloudpayments_api()
             payment_data = cp_api.create_payment_widget_data(order, payment_method)
             
             if not payment_data:
@@ -238,9 +247,6 @@ def register_payment_routes(bp):
                 flash('Ошибка создания платежной формы. Проверьте настройки CloudPayments.', 'error')
                 return redirect(url_for('main.checkout'))
             
-            # Get video types for template
-            video_types = {vt.id: vt for vt in VideoType.query.all()}
-            
             # Render checkout page with CloudPayments widget
             return render_template('main/checkout.html', 
                                  cart_items=cart_items,
@@ -268,15 +274,16 @@ def register_payment_routes(bp):
                 return redirect(url_for('main.index'))
             
             # Check if user has access (if authenticated)
-            if current_user.is_authenticated:
-                if current_user.role not in ['ADMIN', 'MOM', 'OPERATOR']:
-                    if order.customer_id != current_user.id:
+            user = current_user._get_current_object()
+            if user.is_authenticated:
+                if user.role not in STAFF_ROLES:
+                    if order.customer_id != user.id:
                         flash('У вас нет прав на просмотр этого заказа', 'error')
                         return redirect(url_for('main.index'))
             
             # Create payment widget data
             try:
-                cp_api = CloudPaymentsAPI()
+                cp_api = get_cloudpayments_api()
                 payment_method = order.payment_method or 'card'
                 payment_data = cp_api.create_payment_widget_data(order, payment_method)
                 
@@ -300,10 +307,7 @@ def register_payment_routes(bp):
                                      error_message='Ошибка создания платежных данных')
             
             # Get video types for display
-            video_types_dict = {}
-            if order.video_types:
-                video_types = VideoType.query.filter(VideoType.id.in_(order.video_types)).all()
-                video_types_dict = {vt.id: vt for vt in video_types}
+            video_types_dict = get_video_types_map() if order.video_types else {}
             
             logger.info(f'Rendering payment page for order {order.id}, status: {order.status}, payment_data exists: {bool(payment_data)}')
             
@@ -341,20 +345,8 @@ def register_payment_routes(bp):
             session.pop('cart_touched_at', None)
             session.pop('pending_order_id', None)
             
-            # Send order confirmation email
-            try:
-                send_order_confirmation_email(order)
-                logger.info(f'Order confirmation email sent for order {order.generated_order_number}')
-            except Exception as e:
-                logger.error(f'Failed to send order confirmation email: {e}')
-            
-            # Send Telegram notification about order creation (if user has telegram_id)
-            try:
-                from app.utils.telegram_notifier import send_order_created_notification
-                send_order_created_notification(order)
-            except Exception as e:
-                logger.warning(f'Failed to send Telegram notification for order creation: {e}')
-                # Don't fail the whole operation if Telegram notification fails
+            # ✅ Email и Telegram-уведомление отправляются в фоновом потоке (SMTP не блокирует ответ)
+            enqueue_notification(send_order_confirmation_task, order.id)
             
             flash('Заказ успешно оформлен! Оператор скоро свяжется с вами.', 'success')
             return render_template('main/order_success.html', order=order)
@@ -394,9 +386,12 @@ def register_payment_routes(bp):
         """Handle payment return (user came back from payment page)"""
         try:
             # Check if order was created (payment was successful)
-            order = Order.query.filter_by(order_number=order_number).first()
+            # ✅ Нужен только факт существования - строку заказа загрузит payment_success
+            order_id = db.session.execute(
+                select(Order.id).where(Order.order_number == order_number)
+            ).scalar()
             
-            if order:
+            if order_id:
                 # Payment was successful, redirect to success page
                 return redirect(url_for('main.payment_success'))
             else:
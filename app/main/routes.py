@@ -4,8 +4,20 @@ from app.main import bp
 from app.main.payment_routes import register_payment_routes
 from app import db
 from app.models import Event, Category, Athlete, VideoType, Order
-from app.utils.decorators import staff_required
-from sqlalchemy import desc
+from app.utils.decorators import STAFF_ROLES, staff_required
+from app.utils.video_types import get_active_video_types, get_video_type_payloads
+from sqlalchemy import case, desc, func
+from sqlalchemy.orm import joinedload
+
+def _get_staff_order_stats():
+    """Order counters for the staff home page in one conditional-COUNT query"""
+    row = db.session.query(
+        func.count(Order.id).label('total_orders'),
+        func.count(case((Order.status.in_(['checkout_initiated', 'awaiting_payment']), 1), else_=None)).label('pending_orders'),
+        func.count(case((Order.status == 'processing', 1), else_=None)).label('processing_orders'),
+        func.count(case((Order.status == 'completed', 1), else_=None)).label('completed_orders')
+    ).one()
+    return dict(row._mapping)
 
 @bp.route('/')
 def index():
@@ -14,17 +26,13 @@ def index():
     events = Event.query.filter_by(is_active=True).order_by(desc(Event.start_date)).limit(6).all()
     
     # Get video types with prices
-    video_types = VideoType.query.filter_by(is_active=True).all()
+    video_types = get_active_video_types()
     
     # Statistics for staff
     stats = {}
-    if current_user.is_authenticated and current_user.role in ['ADMIN', 'MOM', 'OPERATOR']:
-        stats = {
-            'total_orders': Order.query.count(),
-            'pending_orders': Order.query.filter(Order.status.in_(['checkout_initiated', 'awaiting_payment'])).count(),
-            'processing_orders': Order.query.filter_by(status='processing').count(),
-            'completed_orders': Order.query.filter_by(status='completed').count(),
-        }
+    user = current_user._get_current_object()
+    if user.is_authenticated and user.role in STAFF_ROLES:
+        stats = _get_staff_order_stats()
     
     return render_template('main/index.html', 
                          events=events, 
@@ -40,7 +48,7 @@ def shop():
                        .paginate(page=page, per_page=12, error_out=False)
     
     # Get video types for pricing display
-    video_types = VideoType.query.filter_by(is_active=True).all()
+    video_types = get_active_video_types()
     
     return render_template('main/shop.html', events=events, video_types=video_types)
 
@@ -62,12 +70,20 @@ def tournament(event_id):
     categories = Category.query.filter_by(event_id=event_id)\
                               .order_by(Category.name).all()
     
-    # Add athletes count to each category
+    # Add athletes count to each category (✅ один GROUP BY вместо COUNT на каждую категорию)
+    athletes_counts = {}
+    if categories:
+        athletes_counts = dict(
+            db.session.query(Athlete.category_id, func.count(Athlete.id))
+            .filter(Athlete.category_id.in_([category.id for category in categories]))
+            .group_by(Athlete.category_id)
+            .all()
+        )
     for category in categories:
-        category.athletes_count = Athlete.query.filter_by(category_id=category.id).count()
+        category.athletes_count = athletes_counts.get(category.id, 0)
     
     # Get video types for pricing display
-    video_types = VideoType.query.filter_by(is_active=True).all()
+    video_types = get_active_video_types()
     
     return render_template('main/tournament.html', event=event, categories=categories, video_types=video_types)
 
@@ -86,7 +102,7 @@ def category_athletes(event_id, category_id):
                            .order_by(Athlete.name).all()
     
     # Get video types
-    video_types = VideoType.query.filter_by(is_active=True).all()
+    video_types = get_active_video_types()
     
     return render_template('main/category_athletes.html', 
                          event=event, 
@@ -114,14 +130,9 @@ def athlete_details(athlete_id):
 @bp.route('/api/video-types')
 def get_video_types():
     """Get all active video types for frontend"""
-    video_types = VideoType.query.filter_by(is_active=True).all()
-    
-    return jsonify([{
-        'id': vt.id,
-        'name': vt.name,
-        'description': vt.description,
-        'price': float(vt.price)
-    } for vt in video_types])
+    payloads = get_video_type_payloads()
+    
+    return jsonify([payloads[vt.id] for vt in get_active_video_types()])
 
 @bp.route('/contact')
 def contact():
@@ -134,24 +145,13 @@ register_payment_routes(bp)
 @bp.route('/contact/send', methods=['POST'])
 def send_contact_form():
     """Handle contact form submission"""
-    from flask_mail import Message
-    from app import mail
-    from app.utils.settings import get_contact_email
+    from app.tasks.notifications import enqueue_notification, send_contact_form_task
     
     try:
-        data = request.get_json()
-        
-        # Get contact email from settings
-        contact_email = get_contact_email()
-        
-        # Create email message
-        msg = Message(
-            subject=f"Сообщение с сайта: {data.get('subject', 'Вопрос')}",
-            recipients=[contact_email],
-            sender=current_app.config['MAIL_DEFAULT_SENDER']
-        )
+        data = request.get_json(silent=True) or {}
         
-        msg.body = f"""
+        subject = f"Сообщение с сайта: {data.get('subject', 'Вопрос')}"
+        body = f"""
 Имя: {data.get('name')}
 Email: {data.get('email')}
 Тема: {data.get('subject')}
@@ -160,8 +160,9 @@ Email: {data.get('email')}
 {data.get('message')}
         """
         
-        # Send email
-        mail.send(msg)
+        # ✅ Письмо отправляется фоновым потоком - ответ не ждет SMTP
+        if not enqueue_notification(send_contact_form_task, subject, body):
+            return jsonify({'success': False, 'message': 'Ошибка отправки сообщения'}), 503
         
         return jsonify({'success': True, 'message': 'Сообщение отправлено!'})
         
@@ -190,36 +191,68 @@ def _maybe_expire_cart():
     session.modified = True
     return cart
 
-@bp.route('/cart')
-def cart():
-    """Shopping cart page"""
-    cart = _maybe_expire_cart()
+def _build_cart_items(cart):
+    """
+    Build cart rows for the cart/checkout pages
     
-    # Get cart items with full details
-    cart_items = []
-    total_price = 0
+    Athletes (with category and event) and video types are fetched with two IN queries
+    instead of two lookups per cart line. Malformed keys and missing rows are skipped.
     
+    Returns:
+        (cart_items, total_price)
+    """
+    parsed_cart = []
     for item_id, quantity in cart.items():
         try:
             # Parse item_id to get athlete_id and video_type_id
             athlete_id, video_type_id = map(int, item_id.split('_'))
-            
-            athlete = Athlete.query.get(athlete_id)
-            video_type = VideoType.query.get(video_type_id)
-            
-            if athlete and video_type:
-                item_total = video_type.price * quantity
-                total_price += item_total
-                
-                cart_items.append({
-                    'id': item_id,
-                    'athlete': athlete,
-                    'video_type': video_type,
-                    'quantity': quantity,
-                    'total': item_total
-                })
         except (ValueError, AttributeError):
             continue
+        parsed_cart.append((item_id, athlete_id, video_type_id, quantity))
+    
+    if not parsed_cart:
+        return [], 0
+    
+    athletes_by_id = {
+        athlete.id: athlete
+        for athlete in Athlete.query.options(
+            joinedload(Athlete.category).joinedload(Category.event)
+        ).filter(Athlete.id.in_({athlete_id for _, athlete_id, _, _ in parsed_cart}))
+    }
+    video_types_by_id = {
+        video_type.id: video_type
+        for video_type in VideoType.query.filter(
+            VideoType.id.in_({video_type_id for _, _, video_type_id, _ in parsed_cart})
+        )
+    }
+    
+    cart_items = []
+    total_price = 0
+    for item_id, athlete_id, video_type_id, quantity in parsed_cart:
+        athlete = athletes_by_id.get(athlete_id)
+        video_type = video_types_by_id.get(video_type_id)
+        
+        if athlete and video_type:
+            item_total = video_type.price * quantity
+            total_price += item_total
+            
+            cart_items.append({
+                'id': item_id,
+                'athlete': athlete,
+                'video_type': video_type,
+                'quantity': quantity,
+                'total': item_total
+            })
+    
+    return cart_items, total_price
+
+@bp.route('/cart')
+def cart():
+    """Shopping cart page"""
+    cart = _maybe_expire_cart()
+    
+    # Get cart items with full details
+    cart_items, total_price = _build_cart_items(cart)
     
     return render_template('main/cart.html', 
                          cart_items=cart_items, 
@@ -333,30 +366,7 @@ def checkout():
         return redirect(url_for('main.cart'))
     
     # Get cart items with full details
-    cart_items = []
-    total_price = 0
-    
-    for item_id, quantity in cart.items():
-        try:
-            # Parse item_id to get athlete_id and video_type_id
-            athlete_id, video_type_id = map(int, item_id.split('_'))
-            
-            athlete = Athlete.query.get(athlete_id)
-            video_type = VideoType.query.get(video_type_id)
-            
-            if athlete and video_type:
-                item_total = video_type.price * quantity
-                total_price += item_total
-                
-                cart_items.append({
-                    'id': item_id,
-                    'athlete': athlete,
-                    'video_type': video_type,
-                    'quantity': quantity,
-                    'total': item_total
-                })
-        except (ValueError, AttributeError):
-            continue
+    cart_items, total_price = _build_cart_items(cart)
     
     return render_template('main/checkout.html', 
                          cart_items=cart_items, 
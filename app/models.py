@@ -1,5 +1,11 @@
+import hashlib
+import hmac
+import secrets
+import string
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert
+from sqlalchemy.orm import validates
 from flask_login import UserMixin
 from flask import current_app
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -7,6 +13,9 @@ from app import db
 from app.utils.datetime_utils import moscow_now_naive
 from app.utils.order_status import get_status_badge, get_status_label
 
+_HUMAN_ORDER_ALPHABET = string.ascii_uppercase + string.digits
+_DUMMY_PASSWORD_HASH = None  # built on first use by User.check_password_dummy
+
 class User(UserMixin, db.Model):
     """User model with role-based access control"""
     __tablename__ = 'users'
@@ -27,6 +36,11 @@ class User(UserMixin, db.Model):
     orders = db.relationship('Order', backref='customer', lazy='dynamic', foreign_keys='Order.customer_id')
     audit_logs = db.relationship('AuditLog', backref='user', lazy='dynamic', foreign_keys='AuditLog.user_id')
     
+    @validates('email')
+    def _normalize_email(self, key, email):
+        """Store emails lowercase so lookups by email.lower() hit the unique index"""
+        return email.strip().lower() if email else email
+    
     def set_password(self, password):
         """Hash and set password"""
         self.password_hash = generate_password_hash(password)
@@ -35,6 +49,19 @@ class User(UserMixin, db.Model):
         """Check password hash"""
         return check_password_hash(self.password_hash, password)
     
+    @staticmethod
+    def check_password_dummy(password):
+        """
+        Spend the same hashing time as check_password when there is no user; always False
+        
+        The reference hash uses the default method, so its cost follows generate_password_hash.
+        """
+        global _DUMMY_PASSWORD_HASH
+        if _DUMMY_PASSWORD_HASH is None:
+            _DUMMY_PASSWORD_HASH = generate_password_hash(secrets.token_urlsafe(16))
+        check_password_hash(_DUMMY_PASSWORD_HASH, password)
+        return False
+    
     @staticmethod
     def generate_password():
         """Generate random password with letters and numbers (minimum 8 characters)"""
@@ -58,13 +85,21 @@ class User(UserMixin, db.Model):
         secrets.SystemRandom().shuffle(password)
         return ''.join(password)
     
+    def _reset_password_fingerprint(self):
+        """Keyed digest of the current password hash: changes (and voids reset tokens) on every password change"""
+        return hmac.new(
+            current_app.config['SECRET_KEY'].encode(),
+            (self.password_hash or '').encode(),
+            hashlib.sha256
+        ).hexdigest()
+    
     def get_reset_password_token(self, expires_in=600):
-        """Generate password reset token"""
+        """Generate password reset token (single-use: bound to the current password)"""
         import jwt
         import time
         
         return jwt.encode(
-            {'reset_password': self.id, 'exp': time.time() + expires_in},
+            {'reset_password': self.id, 'pwd': self._reset_password_fingerprint(), 'exp': time.time() + expires_in},
             current_app.config['SECRET_KEY'], algorithm='HS256')
     
     @staticmethod
@@ -73,11 +108,17 @@ class User(UserMixin, db.Model):
         import jwt
         
         try:
-            id = jwt.decode(token, current_app.config['SECRET_KEY'],
-                           algorithms=['HS256'])['reset_password']
-        except:
+            payload = jwt.decode(token, current_app.config['SECRET_KEY'],
+                                 algorithms=['HS256'])
+            user_id = int(payload['reset_password'])
+            fingerprint = str(payload['pwd'])
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            return None
+        user = db.session.get(User, user_id)
+        # ✅ Сравнение за постоянное время; после смены пароля ссылка больше не действует
+        if not user or not hmac.compare_digest(fingerprint, user._reset_password_fingerprint()):
             return None
-        return User.query.get(id)
+        return user
     
     def __repr__(self):
         return f'<User {self.email}>'
@@ -152,6 +193,10 @@ class VideoType(db.Model):
 class Order(db.Model):
     """Order model"""
     __tablename__ = 'orders'
+    __table_args__ = (
+        # ✅ Заказы покупателя: фильтр по статусу и сортировка по дате без отдельной сортировки
+        db.Index('ix_orders_customer_status_created', 'customer_id', 'status', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     order_number = db.Column(db.String(20), unique=True, nullable=False, index=True)
@@ -175,7 +220,7 @@ class Order(db.Model):
     currency = db.Column(db.String(3), default='RUB')
     
     # Contact information
-    contact_email = db.Column(db.String(120), nullable=False)
+    contact_email = db.Column(db.String(120), nullable=False, index=True)  # ✅ Гостевые заказы в order_detail ищутся по email
     contact_phone = db.Column(db.String(20), nullable=True)
     contact_first_name = db.Column(db.String(50), nullable=True)
     contact_last_name = db.Column(db.String(50), nullable=True)
@@ -209,52 +254,32 @@ class Order(db.Model):
     event = db.relationship('Event', overlaps="event_orders")
     category = db.relationship('Category', overlaps="category_orders")
     
+    @validates('contact_email')
+    def _normalize_contact_email(self, key, email):
+        """Store contact emails lowercase to match User.email on exact lookups"""
+        return email.strip().lower() if email else email
+    
     @staticmethod
     def generate_order_number():
-        """Generate unique order number (internal)"""
-        from app import db
-        import random
-        max_attempts = 10
-        
-        for attempt in range(max_attempts):
-            timestamp = moscow_now_naive().strftime('%Y%m%d%H%M%S')
-            order_number = f'MS{timestamp}'
-            
-            # ✅ Проверка уникальности
-            if not Order.query.filter_by(order_number=order_number).first():
-                return order_number
-            
-            # Если коллизия, добавить случайный суффикс
-            order_number = f'MS{timestamp}{random.randint(10, 99)}'
-            if not Order.query.filter_by(order_number=order_number).first():
-                return order_number
+        """
+        Generate unique order number (internal)
         
-        # Если не получилось, использовать UUID
-        import uuid
-        return f'MS{uuid.uuid4().hex[:16].upper()}'
+        Pure Python, no DB lookup: MS + timestamp + 4 random digits (20 chars).
+        A collision is caught by the UNIQUE constraint on commit.
+        """
+        timestamp = moscow_now_naive().strftime('%Y%m%d%H%M%S')
+        return f'MS{timestamp}{secrets.randbelow(10000):04d}'
     
     @staticmethod
     def generate_human_order_number():
-        """Generate human-readable order number"""
-        from app import db
-        import random
-        import string
-        max_attempts = 10
+        """
+        Generate human-readable order number
         
+        Pure Python, no DB lookup: 6 random chars give 36^6 (~2 billion) numbers per day;
+        a collision is caught by the UNIQUE constraint on commit.
+        """
         date_str = moscow_now_naive().strftime('%Y%m%d')
-        
-        for attempt in range(max_attempts):
-            # ✅ Использовать более уникальный идентификатор (6 символов)
-            unique_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-            order_number = f'MS-{date_str}-{unique_id}'
-            
-            # ✅ Проверка уникальности
-            if not Order.query.filter_by(generated_order_number=order_number).first():
-                return order_number
-        
-        # Если не получилось, использовать UUID
-        import uuid
-        unique_id = uuid.uuid4().hex[:8].upper()
+        unique_id = ''.join(secrets.choice(_HUMAN_ORDER_ALPHABET) for _ in range(6))
         return f'MS-{date_str}-{unique_id}'
     
     def is_payment_expired(self):
@@ -309,6 +334,10 @@ class Order(db.Model):
 class Payment(db.Model):
     """Payment model for CloudPayments integration"""
     __tablename__ = 'payments'
+    __table_args__ = (
+        # ✅ Поиск платежа заказа по статусу (capture/refund) - один index seek
+        db.Index('ix_payments_order_id_status', 'order_id', 'status'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=True, index=True)
@@ -369,14 +398,28 @@ class AuditLog(db.Model):
     
     @staticmethod
     def create_log(user_id=None, action=None, resource_type=None, resource_id=None, 
-                   details=None, ip_address=None, user_agent=None, commit=False):
+                   details=None, ip_address=None, user_agent=None, commit=False, bulk=False):
         """
         Create audit log entry
         
         Args:
             commit: Если True, коммитит отдельно. Если False (по умолчанию), 
                     нужно коммитить вместе с основной транзакцией.
+            bulk: Если True, строка вставляется одним INSERT в обход unit of work
+                  (без объекта в identity map); возвращается None.
         """
+        if bulk:
+            AuditLog.create_logs_bulk([{
+                'user_id': user_id,
+                'action': action,
+                'resource_type': resource_type,
+                'resource_id': resource_id,
+                'details': details,
+                'ip_address': ip_address,
+                'user_agent': user_agent,
+            }], commit=commit)
+            return None
+        
         log = AuditLog(
             user_id=user_id,
             action=action,
@@ -391,6 +434,39 @@ class AuditLog(db.Model):
             db.session.commit()
         return log
     
+    @staticmethod
+    def create_logs_bulk(entries, commit=False, connection=None):
+        """
+        Insert several audit log entries in one batch (ORM bulk INSERT, executemany)
+        
+        Args:
+            entries: Список dict с полями AuditLog (user_id, action, resource_type, ...).
+                     Пропускает ORM identity map и события - подходит для пакетной записи.
+                     created_at можно передать, чтобы совпадало с временем изменения заказа.
+            commit: Если True, коммитит отдельно.
+            connection: Если передан, INSERT выполняется на этом соединении, а не в
+                        db.session (commit тогда на вызывающем).
+        """
+        if not entries:
+            return
+        default_created_at = moscow_now_naive()
+        rows = [{
+            'user_id': entry.get('user_id'),
+            'action': entry.get('action'),
+            'resource_type': entry.get('resource_type'),
+            'resource_id': entry.get('resource_id'),
+            'details': entry.get('details'),
+            'ip_address': entry.get('ip_address'),
+            'user_agent': entry.get('user_agent'),
+            'created_at': entry.get('created_at') or default_created_at,
+        } for entry in entries]
+        if connection is not None:
+            connection.execute(insert(AuditLog), rows)
+            return
+        db.session.execute(insert(AuditLog), rows)
+        if commit:
+            db.session.commit()
+    
     @staticmethod
     def log_user_action(user_id, action, ip_address=None, user_agent=None, details=None):
         """Log user action (login, logout, etc.)"""
@@ -2,12 +2,14 @@ from flask import render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required, current_user
 from app.mom import bp
 from app.utils.decorators import role_required
-from app.models import Order, Event, User, VideoType, Payment, db
+from app.models import Order, Event, User, Payment, db
 from sqlalchemy import desc, func, or_
 from sqlalchemy.orm import joinedload
 from datetime import datetime
 import logging
 from app.utils.order_status import expand_status_filter, get_status_filter_choices
+from app.utils.db_retry import is_sqlite_busy
+from app.utils.video_types import get_video_types_dict
 
 logger = logging.getLogger(__name__)
 
@@ -112,9 +114,7 @@ def dashboard():
     unread_counts, total_counts = _get_chat_counts(orders.items, current_user.id)
     
     # Get video types for display
-    from app.models import VideoType
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     return render_template('mom/dashboard.html', 
                          need_payment=need_payment,
@@ -158,8 +158,7 @@ def orders():
     )
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     unread_counts, total_counts = _get_chat_counts(orders.items, current_user.id)
     
@@ -273,8 +272,7 @@ def order_detail(order_id):
     order = Order.query.get_or_404(order_id)
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     return render_template('mom/order_detail.html', order=order, video_types_dict=video_types_dict)
 
@@ -316,7 +314,7 @@ def send_links(order_id):
                 db.session.commit()
                 break  # Success, exit retry loop
             except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                if is_sqlite_busy(e) and attempt < max_retries - 1:
                     db.session.rollback()
                     wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                     logger.warning(f'Database locked in send_links (mom), retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
@@ -329,25 +327,13 @@ def send_links(order_id):
                     logger.error(f'Error updating order status in send_links after {attempt + 1} attempts: {str(e)}')
                     raise
         
-        # ✅ Отправляем email и уведомления ПОСЛЕ коммита (не блокирует транзакцию)
-        # Send video links email to customer
-        try:
-            from app.utils.email import send_video_links_email
-            send_video_links_email(order)
-        except Exception as e:
-            logger.error(f'Failed to send video links email: {e}')
-        
-        # Send Telegram notification with links (if user has telegram_id)
-        try:
-            from app.utils.telegram_notifier import send_video_links_notification
-            send_video_links_notification(order)
-        except Exception as e:
-            logger.warning(f'Failed to send Telegram notification with links: {e}')
-            # Don't fail the whole operation if Telegram notification fails
+        # ✅ Отправляем email и уведомления ПОСЛЕ коммита в фоновом потоке (не блокирует ответ)
+        from app.tasks.notifications import enqueue_notification, send_video_links_task
+        enqueue_notification(send_video_links_task, order.id)
         
         # Log action
-        from app.models import AuditLog
-        AuditLog.create_log(
+        from app.tasks.audit import enqueue_audit_log
+        enqueue_audit_log(
             user_id=current_user.id,
             action='LINKS_SENT',
             resource_type='Order',
@@ -422,7 +408,7 @@ def refund_order(order_id):
     
     try:
         # Process refund through CloudPayments API
-        from app.utils.cloudpayments import CloudPaymentsAPI
+        from app.utils.cloudpayments import get_cloudpayments_api
         
         # Find payment for this order
         payment = Payment.query.filter_by(order_id=order_id).first()
@@ -430,7 +416,7 @@ def refund_order(order_id):
             return jsonify({'success': False, 'error': 'Платеж не найден'})
         
         # Process refund
-        cp_api = CloudPaymentsAPI()
+        cp_api = get_cloudpayments_api()
         refund_result = cp_api.refund_payment(
             transaction_id=payment.cp_transaction_id,
             amount=None,  # Full refund
@@ -457,7 +443,7 @@ def refund_order(order_id):
                     db.session.commit()
                     break  # Success, exit retry loop
                 except OperationalError as e:
-                    if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                    if is_sqlite_busy(e) and attempt < max_retries - 1:
                         db.session.rollback()
                         wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                         logger.warning(f'Database locked in refund_order (mom), retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
@@ -8,6 +8,8 @@ from sqlalchemy.orm import joinedload
 import logging
 from app.utils.order_status import expand_status_filter
 from app.utils.datetime_utils import moscow_now_naive
+from app.utils.db_retry import is_sqlite_busy
+from app.utils.video_types import get_video_types_dict
 
 logger = logging.getLogger(__name__)
 
@@ -140,8 +142,7 @@ def dashboard():
         total_counts = {}
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     return render_template('operator/dashboard.html',
                          new_orders=new_orders,
@@ -311,7 +312,7 @@ def take_order(order_id):
                 flash('Заказ взят в обработку', 'success')
                 break  # Success, exit retry loop
             except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                if is_sqlite_busy(e) and attempt < max_retries - 1:
                     db.session.rollback()
                     wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                     logger.warning(f'Database locked in take_order, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
@@ -367,7 +368,7 @@ def complete_order(order_id):
                 db.session.commit()
                 break  # Success, exit retry loop
             except OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                if is_sqlite_busy(e) and attempt < max_retries - 1:
                     db.session.rollback()
                     wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                     logger.warning(f'Database locked in complete_order, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
@@ -401,8 +402,7 @@ def order_detail(order_id):
         return redirect(url_for('operator.dashboard'))
     
     # Get video types for display
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     return render_template('operator/order_detail.html', order=order, video_types_dict=video_types_dict)
 @bp.route('/orders/<int:order_id>/upload-links', methods=['GET', 'POST'])
@@ -503,7 +503,7 @@ def upload_video_links(order_id):
                     db.session.commit()
                     break  # Success, exit retry loop
                 except OperationalError as e:
-                    if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                    if is_sqlite_busy(e) and attempt < max_retries - 1:
                         db.session.rollback()
                         wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                         logger.warning(f'Database locked in upload_video_links, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
@@ -588,8 +588,7 @@ def statistics():
     ).order_by(desc(Order.created_at)).all()
     
     # Get all video types
-    video_types = VideoType.query.all()
-    video_types_dict = {str(vt.id): vt for vt in video_types}
+    video_types_dict = get_video_types_dict()
     
     # Calculate earnings
     total_earnings = 0
@@ -0,0 +1,157 @@
+"""
+Buffered audit log writer
+Audit events that are not part of a business transaction (login, logout, password changes)
+are queued and inserted in batches by a daemon thread: one INSERT batch + one COMMIT
+for many events instead of a write per request
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from flask import current_app
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# ✅ Очередь ограничена: при недоступной БД не копим события в памяти бесконечно
+AUDIT_QUEUE_MAXSIZE = 10000
+AUDIT_BATCH_SIZE = 512          # max rows per INSERT batch
+AUDIT_FLUSH_INTERVAL = 0.2      # seconds to wait for more rows after the first one
+
+
+class AuditLogBuffer:
+    """
+    Bounded queue of AuditLog rows (dicts) drained in batches by a lazily started daemon thread
+
+    Rows still queued at interpreter exit are flushed by an atexit hook.
+    """
+
+    def __init__(self, name, maxsize, batch_size, flush_interval):
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._app = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _next_batch(self):
+        """Block for the first row, then collect more until the batch is full or the interval ends"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Insert one batch in its own transaction (runs inside an app context)"""
+        from app.models import AuditLog
+        from app.utils.db_retry import sqlite_retry
+
+        # ✅ Отдельное соединение, а не db.session: в тестах _write вызывается inline из запроса,
+        # ✅ и коммит/remove() scoped session отсоединили бы объекты запроса
+        @sqlite_retry(rollback_session=False)
+        def _persist():
+            with db.engine.begin() as connection:
+                AuditLog.create_logs_bulk(batch, connection=connection)
+
+        try:
+            _persist()
+        except Exception as e:
+            logger.error('%s: failed to write %d audit rows: %s', self.name, len(batch), e, exc_info=True)
+
+    def _worker_loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with self._app.app_context():
+                    self._write(batch)
+            except Exception as e:
+                logger.error('%s error: %s', self.name, e, exc_info=True)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush_pending(self):
+        """Write whatever is still queued (called at exit; the daemon thread is not joined)"""
+        if self._app is None:
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            with self._app.app_context():
+                self._write(batch)
+
+    def _ensure_worker(self):
+        """Start the worker thread lazily (after gunicorn fork)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._app is None:
+                    atexit.register(self.flush_pending)
+                self._app = current_app._get_current_object()
+                self._thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=self.name,
+                    daemon=True
+                )
+                self._thread.start()
+                logger.info('%s thread started', self.name)
+
+    def enqueue(self, row):
+        """
+        Queue one AuditLog row (dict of column values)
+
+        Never blocks the request: when the queue is full the row is dropped and logged.
+
+        Returns:
+            True if the row was queued (or written inline in testing), False otherwise
+        """
+        # В тестах пишем синхронно, чтобы результат был детерминированным
+        if current_app.config.get('TESTING'):
+            self._write([row])
+            return True
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            logger.error('%s queue is full, dropping audit row %s', self.name, row.get('action'))
+            return False
+
+
+_audit_buffer = AuditLogBuffer('audit-log-writer', AUDIT_QUEUE_MAXSIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL)
+
+
+def enqueue_audit_log(user_id=None, action=None, resource_type=None, resource_id=None,
+                      details=None, ip_address=None, user_agent=None):
+    """
+    Record an audit event outside of the caller's transaction
+
+    For events that do not accompany a data change in the same request. When the row must
+    commit atomically with the change, use AuditLog.create_log(commit=False) instead.
+    ip_address/user_agent must be captured by the caller: the writer thread has no request.
+    """
+    return _audit_buffer.enqueue({
+        'user_id': user_id,
+        'action': action,
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'details': details,
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+    })
@@ -0,0 +1,38 @@
+"""
+Background task for SQLite maintenance
+Keeps query planner statistics fresh with PRAGMA optimize
+"""
+
+import logging
+from app import db
+
+logger = logging.getLogger(__name__)
+
+def optimize_sqlite_with_context():
+    """Wrapper that creates app context for optimize_sqlite"""
+    # Получаем app из глобальной переменной scheduler
+    from app.tasks.scheduler import _app_instance
+    if _app_instance:
+        with _app_instance.app_context():
+            optimize_sqlite()
+    else:
+        # Fallback: пытаемся использовать current_app если доступен
+        try:
+            from flask import current_app
+            with current_app.app_context():
+                optimize_sqlite()
+        except RuntimeError:
+            logger.error('No application context available for optimize_sqlite')
+
+def optimize_sqlite():
+    """
+    Run PRAGMA optimize so SQLite refreshes statistics for tables whose indexes were used
+    Runs every 15 minutes via APScheduler (SQLite only)
+    """
+    try:
+        # ✅ Отдельное соединение из пула, без ORM-сессии; ANALYZE выполняется только там, где нужно
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA optimize')
+        logger.debug('PRAGMA optimize completed')
+    except Exception as e:
+        logger.error(f'Error in optimize_sqlite task: {str(e)}')
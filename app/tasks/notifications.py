@@ -0,0 +1,158 @@
+"""
+Background notification worker
+Sends emails and Telegram notifications outside of the request thread,
+and writes side-effect rows (system chat messages) that the response does not wait for
+"""
+
+import logging
+from app import db
+from app.tasks.worker import BackgroundTaskQueue
+
+logger = logging.getLogger(__name__)
+
+# ✅ Очередь ограничена: если SMTP/Telegram недоступны, не копим задачи в памяти бесконечно
+NOTIFY_QUEUE_MAXSIZE = 500
+NOTIFY_ENQUEUE_TIMEOUT = 5  # seconds to block on a full queue before dropping the task
+
+_notify_queue = BackgroundTaskQueue('notification-worker', NOTIFY_QUEUE_MAXSIZE, NOTIFY_ENQUEUE_TIMEOUT)
+
+
+def enqueue_notification(task, *args):
+    """
+    Queue task(*args) for the background notification worker.
+
+    Pass IDs, not ORM objects: the task runs in a separate thread with its own session.
+
+    Returns:
+        True if the task was queued (or executed inline in testing), False otherwise
+    """
+    return _notify_queue.enqueue(task, *args)
+
+
+def send_video_links_task(order_id):
+    """Send video links to the customer by email and Telegram"""
+    from app.models import Order
+    from app.utils.email import send_video_links_email
+    from app.utils.telegram_notifier import send_video_links_notification
+
+    order = db.session.get(Order, order_id)
+    if not order:
+        logger.warning('Order %s not found, video links notification skipped', order_id)
+        return
+
+    try:
+        send_video_links_email(order)
+    except Exception as e:
+        logger.error('Failed to send video links email for order %s: %s', order_id, e)
+
+    try:
+        result = send_video_links_notification(order)
+        logger.info('Telegram notification result for order %s: %s', order_id, result)
+    except Exception as e:
+        logger.error('Failed to send Telegram notification with links for order %s: %s', order_id, e, exc_info=True)
+
+
+def send_order_confirmation_task(order_id):
+    """Send the order confirmation email and the Telegram order-created notification"""
+    from app.models import Order
+    from app.utils.email import send_order_confirmation_email
+    from app.utils.telegram_notifier import send_order_created_notification
+
+    order = db.session.get(Order, order_id)
+    if not order:
+        logger.warning('Order %s not found, order confirmation skipped', order_id)
+        return
+
+    try:
+        send_order_confirmation_email(order)
+        logger.info('Order confirmation email sent for order %s', order.generated_order_number)
+    except Exception as e:
+        logger.error('Failed to send order confirmation email for order %s: %s', order_id, e)
+
+    try:
+        send_order_created_notification(order)
+    except Exception as e:
+        logger.warning('Failed to send Telegram notification for order creation %s: %s', order_id, e)
+
+
+def reset_password_task(user_id):
+    """
+    Generate a new password for the user, store its hash and email it
+    
+    The password exists only inside this task: it is never passed through the queue.
+    """
+    from app.models import User
+    from app.utils.db_retry import sqlite_retry
+    from app.utils.email import send_new_password_email
+
+    new_password = User.generate_password()
+
+    @sqlite_retry()
+    def _persist():
+        user = db.session.get(User, user_id)
+        if not user:
+            return None
+        user.set_password(new_password)
+        db.session.commit()
+        return user
+
+    user = _persist()
+    if not user:
+        logger.warning('User %s not found, password reset skipped', user_id)
+        return
+
+    try:
+        send_new_password_email(user, new_password)
+    except Exception:
+        logger.exception('Error sending new password email to user %s', user_id)
+
+
+def send_contact_form_task(subject, body):
+    """Forward a contact form message to the shop's contact email"""
+    from flask import current_app
+    from flask_mail import Message
+    from app import mail
+    from app.utils.settings import get_contact_email
+
+    try:
+        msg = Message(
+            subject=subject,
+            recipients=[get_contact_email()],
+            sender=current_app.config['MAIL_DEFAULT_SENDER']
+        )
+        msg.body = body
+        mail.send(msg)
+    except Exception:
+        logger.exception('Error sending contact form message "%s"', subject)
+
+
+def send_order_cancellation_task(order_id, cancellation_reason=None):
+    """Send the order cancellation email"""
+    from app.models import Order
+    from app.utils.email import send_order_cancellation_email
+
+    order = db.session.get(Order, order_id)
+    if not order:
+        logger.warning('Order %s not found, cancellation email skipped', order_id)
+        return
+
+    try:
+        send_order_cancellation_email(order, cancellation_reason)
+    except Exception:
+        logger.exception('Error sending cancellation email for order %s', order_id)
+
+
+def post_status_change_message_task(order_id, new_status, comment, user_id):
+    """Write the system chat message for an order status change (audit is written by the caller's transaction)"""
+    from app.utils.db_retry import sqlite_retry
+    from app.utils.order_chat import stage_status_change_message
+
+    @sqlite_retry()
+    def _persist():
+        stage_status_change_message(order_id, new_status, comment, user_id)
+        db.session.commit()
+
+    try:
+        _persist()
+    except Exception as e:
+        logger.error('Failed to post status message for order %s: %s', order_id, e, exc_info=True)
@@ -9,7 +9,7 @@ from flask import current_app
 from sqlalchemy import or_, and_
 from app import db
 from app.models import Order, AuditLog
-from app.utils.cloudpayments import CloudPaymentsAPI
+from app.utils.cloudpayments import get_cloudpayments_api
 from app.utils.datetime_utils import moscow_now_naive
 
 logger = logging.getLogger(__name__)
@@ -79,7 +79,7 @@ def cancel_expired_orders():
         
         logger.info(f'Found {len(expired_orders)} expired orders to cancel')
         
-        cp_api = CloudPaymentsAPI()
+        cp_api = get_cloudpayments_api()
         
         for order in expired_orders:
             try:
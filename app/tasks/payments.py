@@ -0,0 +1,144 @@
+"""
+Background workers for CloudPayments card charges
+Keeps the slow /payments/cards/charge call off the request thread
+
+Queued charges live only in process memory: a restart drops them without a Payment row.
+The status endpoint stops reporting "pending" after PAYMENT_RESULT_TIMEOUT, so the client
+gets a terminal answer for such a charge instead of polling forever.
+"""
+
+import logging
+import requests
+from app import db
+from app.tasks.worker import BackgroundTaskQueue
+
+logger = logging.getLogger(__name__)
+
+# ✅ Отдельная очередь: письма и Telegram не задерживают списания
+PAYMENT_QUEUE_MAXSIZE = 100
+PAYMENT_ENQUEUE_TIMEOUT = 2  # seconds to block on a full queue before rejecting the charge
+PAYMENT_RESULT_TIMEOUT = 300  # seconds after which a charge without a Payment row counts as lost
+
+# ✅ Пул потоков по размеру HTTP-пула: списания идут параллельно, а не друг за другом
+_payment_queue = BackgroundTaskQueue(
+    'payment-worker', PAYMENT_QUEUE_MAXSIZE, PAYMENT_ENQUEUE_TIMEOUT,
+    workers_config_key='HTTP_POOL_MAXSIZE'
+)
+
+
+def enqueue_charge(order_id, payment_data, payment_method):
+    """
+    Queue a cryptogram charge for the payment worker
+    
+    Returns:
+        True if the charge was queued, False if the queue is full
+    """
+    return _payment_queue.enqueue(charge_cryptogram_task, order_id, payment_data, payment_method)
+
+
+def _record_charge(order_id, payment_data, payment_method, payload, status, transaction_id=None):
+    """Store a Payment row (without touching the order) so the status endpoint can report the outcome"""
+    from app.models import Payment
+    from app.utils.db_retry import sqlite_retry
+
+    @sqlite_retry()
+    def _persist():
+        db.session.add(Payment(
+            order_id=order_id,
+            cp_transaction_id=transaction_id,
+            amount=payment_data['Amount'],
+            currency=payment_data['Currency'],
+            status=status,
+            method=payment_method,
+            email=payment_data.get('Email'),
+            raw_payload=payload
+        ))
+        db.session.commit()
+
+    _persist()
+
+
+def _record_failed_charge(order_id, payment_data, payment_method, payload):
+    """Store a failed Payment so the status endpoint can report the outcome"""
+    _record_charge(order_id, payment_data, payment_method, payload, 'failed')
+
+
+def charge_cryptogram_task(order_id, payment_data, payment_method):
+    """Charge the card cryptogram and record the result (authorized payment + paid order, or failed payment)"""
+    from app.models import Order, Payment
+    from app.utils.cloudpayments import get_cloudpayments_api
+    from app.utils.db_retry import sqlite_retry
+
+    cp_api = get_cloudpayments_api()
+
+    try:
+        response = cp_api.session.post(cp_api.charge_url, headers=cp_api.json_headers, json=payment_data)
+    except requests.RequestException as e:
+        logger.error('Payment API request failed for order %s: %s', order_id, e)
+        _record_failed_charge(order_id, payment_data, payment_method, {'Message': 'Payment API unavailable'})
+        return
+
+    if response.status_code != 200:
+        # HTTP error
+        logger.error('Payment API error: %s - %s', response.status_code, response.text)
+        _record_failed_charge(order_id, payment_data, payment_method,
+                              {'Message': f'Payment API error: {response.status_code}'})
+        return
+
+    try:
+        result = response.json()
+    except ValueError:
+        # ✅ Не-JSON ответ: без записи платежа статус-эндпоинт отвечал бы "pending" бесконечно
+        logger.error('Payment API returned a non-JSON response for order %s', order_id)
+        _record_failed_charge(order_id, payment_data, payment_method,
+                              {'Message': 'Payment API returned an invalid response'})
+        return
+
+    if not result.get('Success'):
+        # Payment failed
+        logger.error('Payment failed for order %s: %s', order_id, result.get('Message', 'Unknown error'))
+        _record_failed_charge(order_id, payment_data, payment_method, result)
+        return
+
+    # Payment successful
+    transaction_id = result.get('TransactionId')
+    amount = payment_data['Amount']
+
+    @sqlite_retry()
+    def _persist_payment_and_update_order():
+        order = db.session.get(Order, order_id)
+        if not order:
+            raise ValueError('Order not found during payment persistence')
+        db.session.add(Payment(
+            order_id=order_id,
+            cp_transaction_id=transaction_id,
+            amount=amount,
+            currency=payment_data['Currency'],
+            status='authorized',
+            method=payment_method,
+            email=payment_data.get('Email'),
+            raw_payload=result
+        ))
+        order.status = 'paid'
+        order.paid_amount = amount
+        order.payment_intent_id = transaction_id
+        order.payment_method = payment_method
+        db.session.commit()
+
+    try:
+        _persist_payment_and_update_order()
+    except Exception:
+        # ✅ Деньги уже списаны: фиксируем это явно, а не только общим traceback воркера
+        db.session.rollback()
+        logger.error('Charge succeeded but was not recorded: order %s, TransactionId %s',
+                     order_id, transaction_id, exc_info=True)
+        try:
+            # Хотя бы платеж, чтобы статус-эндпоинт не отвечал "pending" бесконечно
+            _record_charge(order_id, payment_data, payment_method, result, 'authorized', transaction_id)
+        except Exception:
+            db.session.rollback()
+            logger.error('Payment row could not be stored either: order %s, TransactionId %s',
+                         order_id, transaction_id, exc_info=True)
+        return
+
+    logger.info('Payment successful for order %s, transaction %s', order_id, transaction_id)
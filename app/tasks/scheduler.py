@@ -64,6 +64,16 @@ def init_scheduler(app):
         replace_existing=True
     )
     
+    # Refresh SQLite planner statistics every 15 minutes
+    if app.config.get('SQLALCHEMY_DATABASE_URI', '').startswith('sqlite'):
+        scheduler.add_job(
+            func='app.tasks.db_maintenance:optimize_sqlite_with_context',
+            trigger=IntervalTrigger(minutes=15),
+            id='optimize_sqlite',
+            name='SQLite PRAGMA optimize',
+            replace_existing=True
+        )
+    
     # Start scheduler
     try:
         scheduler.start()
@@ -0,0 +1,106 @@
+"""
+Bounded in-process task queue served by a daemon thread
+Used for work the HTTP response does not have to wait for (notifications, payment charges)
+"""
+
+import logging
+import queue
+import threading
+from flask import current_app, has_request_context, request
+from app import db
+
+logger = logging.getLogger(__name__)
+
+
+def _task_ref(args):
+    """Loggable reference to a task: its leading int argument (order/user id), never the other args"""
+    if args and isinstance(args[0], int):
+        return args[0]
+    return None
+
+
+class BackgroundTaskQueue:
+    """
+    Bounded queue + lazily started daemon worker threads
+    
+    workers threads drain the queue; workers_config_key names an app config value that
+    overrides the count (read when the threads start).
+    
+    Each task runs inside app.test_request_context(base_url=...) so url_for(..., _external=True)
+    works, and the scoped DB session is removed after every task.
+    """
+    
+    def __init__(self, name, maxsize, enqueue_timeout, workers=1, workers_config_key=None):
+        self.name = name
+        self.enqueue_timeout = enqueue_timeout  # seconds to block on a full queue before dropping the task
+        self.workers = workers
+        self.workers_config_key = workers_config_key
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+    
+    def _worker_loop(self):
+        """Drain the queue, running each task in its own app/request context"""
+        while True:
+            app, base_url, task, args = self._queue.get()
+            try:
+                # test_request_context нужен для url_for(..., _external=True) в шаблонах писем
+                with app.test_request_context(base_url=base_url):
+                    try:
+                        task(*args)
+                    except Exception as e:
+                        logger.error('%s: task %s failed: %s', self.name, task.__name__, e, exc_info=True)
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                logger.error('%s error: %s', self.name, e, exc_info=True)
+            finally:
+                self._queue.task_done()
+    
+    def _ensure_worker(self):
+        """Start the worker threads lazily (after gunicorn fork)"""
+        if self._threads and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._lock:
+            workers = self.workers
+            if self.workers_config_key:
+                workers = current_app.config.get(self.workers_config_key, workers)
+            alive = [thread for thread in self._threads if thread.is_alive()]
+            for _ in range(workers - len(alive)):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=self.name,
+                    daemon=True
+                )
+                thread.start()
+                alive.append(thread)
+            if len(alive) != len(self._threads):
+                logger.info('%s: %d worker threads running', self.name, len(alive))
+            self._threads = alive
+    
+    def enqueue(self, task, *args):
+        """
+        Queue task(*args) for the worker thread.
+        
+        Pass IDs, not ORM objects: the task runs in a separate thread with its own session.
+        Blocks up to enqueue_timeout seconds when the queue is full (backpressure).
+        
+        Returns:
+            True if the task was queued (or executed inline in testing), False otherwise
+        """
+        app = current_app._get_current_object()
+        
+        # В тестах выполняем синхронно, чтобы результат был детерминированным
+        if app.config.get('TESTING'):
+            task(*args)
+            return True
+        
+        base_url = request.url_root if has_request_context() else None
+        self._ensure_worker()
+        try:
+            self._queue.put((app, base_url, task, args), timeout=self.enqueue_timeout)
+            return True
+        except queue.Full:
+            # ✅ Аргументы задач не логируем: там могут быть платежные данные и пароли
+            logger.error('%s queue is full, dropping task %s (id %s)', self.name, task.__name__, _task_ref(args))
+            return False
@@ -17,6 +17,7 @@ from app.models import User, Event, Category, Athlete, Order, VideoType, Payment
 from app import db
 from app.utils.cloudpayments import CloudPaymentsAPI
 from app.utils.email import send_user_credentials_email
+from app.utils.db_retry import is_sqlite_busy
 import json
 from datetime import datetime
 from flask import current_app, url_for
@@ -1041,7 +1042,7 @@ class TelegramBotManager:
                         db.session.commit()
                         break  # Success
                     except OperationalError as e:
-                        if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                        if is_sqlite_busy(e) and attempt < max_retries - 1:
                             db.session.rollback()
                             wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                             logger.warning(f'Database locked in bot order creation, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
@@ -1575,7 +1576,7 @@ class TelegramBotManager:
                 return False
             
             # Find user by email
-            user = User.query.filter_by(email=order.contact_email).first()
+            user = User.query.filter_by(email=order.contact_email.lower()).first()
             if not user or not user.telegram_id:
                 # ✅ 152-ФЗ: Не логируем email на уровне INFO
                 logger.info(f"User for order {order.id} not found in Telegram or not registered, skipping Telegram notification")
@@ -1645,7 +1646,7 @@ class TelegramBotManager:
             # Find user by email
             # ✅ 152-ФЗ: Не логируем email на уровне INFO
             logger.info(f"[send_video_links] Looking for user for order {order.id}")
-            user = User.query.filter_by(email=order.contact_email).first()
+            user = User.query.filter_by(email=order.contact_email.lower()).first()
             
             if not user:
                 logger.info(f"[send_video_links] User for order {order.id} not found in database, skipping Telegram notification")
@@ -10,6 +10,7 @@ from datetime import timedelta
 from app.models import Event, Category, Athlete, VideoType, Order
 from app import db
 from app.utils.datetime_utils import moscow_now_naive
+from app.utils.db_retry import is_sqlite_busy
 from .base import BaseHandler
 
 logger = logging.getLogger(__name__)
@@ -264,7 +265,7 @@ class OrderingHandler(BaseHandler):
                         db.session.commit()
                         break  # Success
                     except OperationalError as e:
-                        if 'database is locked' in str(e).lower() and attempt < max_retries - 1:
+                        if is_sqlite_busy(e) and attempt < max_retries - 1:
                             db.session.rollback()
                             wait_time = retry_delay * (2 ** attempt) + random.uniform(0, 0.1)
                             logger.warning(f'Database locked in OrderingHandler, retrying in {wait_time:.2f}s (attempt {attempt + 1}/{max_retries})')
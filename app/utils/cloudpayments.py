@@ -3,17 +3,18 @@ Real CloudPayments Integration
 Working with actual CloudPayments API
 """
 
+import base64
 import hmac
 import hashlib
 import json
 import os
-import requests
 from datetime import timedelta
 from typing import Dict, Optional, Any
 from flask import current_app, request
 from app.models import Order, Payment, User
 from app import db
 from app.utils.datetime_utils import moscow_now_naive
+from app.utils.http import cp_session
 import logging
 
 # Optional cloudpayments import
@@ -40,6 +41,24 @@ class CloudPaymentsAPI:
         self.currency = current_app.config.get('CLOUDPAYMENTS_CURRENCY', 'RUB')
         self.test_mode = current_app.config.get('CLOUDPAYMENTS_TEST_MODE', False)
         self.base_url = 'https://api.cloudpayments.ru'
+        # ✅ URL эндпоинтов собираются один раз, а не f-строкой на каждый вызов
+        self.charge_url = f'{self.base_url}/payments/cards/charge'
+        self.confirm_url = f'{self.base_url}/payments/confirm'
+        self.void_url = f'{self.base_url}/payments/void'
+        self.refund_url = f'{self.base_url}/payments/refund'
+        
+        # ✅ Basic auth считается один раз: public_id/api_secret не меняются за время жизни объекта
+        auth_string = f"{self.public_id}:{self.api_secret}"
+        auth_token = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
+        self.auth_header = f'Basic {auth_token}'
+        self.json_headers = {
+            'Content-Type': 'application/json',
+            'Authorization': self.auth_header
+        }
+        
+        # ✅ Общая HTTP-сессия процесса (app/utils/http.py): keep-alive пул к CloudPayments
+        # ✅ для всех экземпляров, включая создаваемые Telegram-ботом; таймаут (connect, read) задан в сессии
+        self.session = cp_session()
         
         # Проверка наличия ключей - в dev режиме не бросаем ошибку, только предупреждение
         if not self.public_id or not self.api_secret:
@@ -281,18 +300,12 @@ class CloudPaymentsAPI:
                 }
             
             # Call CloudPayments API to refund
-            url = f"{self.base_url}/payments/refund"
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Basic {self._get_auth_token()}'
-            }
-            
             data = {
                 'TransactionId': int(transaction_id),
                 'Amount': refund_amount
             }
             
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+            response = self.session.post(self.refund_url, headers=self.json_headers, json=data)
             
             if response.status_code == 200:
                 result = response.json()
@@ -351,7 +364,6 @@ class CloudPaymentsAPI:
             return False  # ✅ ОТКЛОНЯЕМ БЕЗ ПОДПИСИ
         
         try:
-            import base64
             
             # Убираем префикс если есть
             clean_signature = signature.strip()
@@ -409,12 +421,6 @@ class CloudPaymentsAPI:
             logger.error(traceback.format_exc())
             return False  # ✅ ПРИ ОШИБКЕ ОТКЛОНЯЕМ
     
-    def _get_auth_token(self) -> str:
-        """Get base64 encoded auth token"""
-        import base64
-        auth_string = f"{self.public_id}:{self.api_secret}"
-        return base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-    
     def confirm_payment(self, transaction_id: str, amount: float = None, user_id: int = None) -> Dict[str, Any]:
         """
         Confirm (capture) payment for two-stage transactions
@@ -445,14 +451,10 @@ class CloudPaymentsAPI:
             }
             
             # Make API request to confirm payment
-            response = requests.post(
-                f'{self.base_url}/payments/confirm',
+            response = self.session.post(
+                self.confirm_url,
                 json=confirm_data,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Basic {self._get_auth_token()}'
-                },
-                timeout=30
+                headers=self.json_headers
             )
             
             if response.status_code == 200:
@@ -505,14 +507,10 @@ class CloudPaymentsAPI:
             }
             
             # Make API request to void payment
-            response = requests.post(
-                f'{self.base_url}/payments/void',
+            response = self.session.post(
+                self.void_url,
                 json=void_data,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Basic {self._get_auth_token()}'
-                },
-                timeout=30
+                headers=self.json_headers
             )
             
             if response.status_code == 200:
@@ -535,3 +533,16 @@ class CloudPaymentsAPI:
         except Exception as e:
             logger.error(f'Error voiding payment {transaction_id}: {str(e)}')
             return {'success': False, 'error': str(e)}
+
+
+def get_cloudpayments_api() -> CloudPaymentsAPI:
+    """
+    Get CloudPaymentsAPI instance shared by the current app
+    
+    Reusing one instance keeps its HTTP connections to CloudPayments alive across requests.
+    """
+    cp_api = current_app.extensions.get('cloudpayments_api')
+    if cp_api is None:
+        cp_api = CloudPaymentsAPI()
+        current_app.extensions['cloudpayments_api'] = cp_api
+    return cp_api
@@ -0,0 +1,93 @@
+"""
+Retry helpers for SQLite "database is locked" errors
+"""
+
+import functools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from sqlalchemy.exc import OperationalError
+from app import db
+
+logger = logging.getLogger(__name__)
+
+_rng = random.Random()
+
+# Primary SQLite result codes (extended codes keep them in the low byte)
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+
+def is_sqlite_busy(exc):
+    """
+    Check whether an OperationalError is SQLite's "database is locked" (SQLITE_BUSY / SQLITE_LOCKED)
+    
+    Uses sqlite3's sqlite_errorcode (Python 3.11+) when available and falls back
+    to the driver message for older interpreters.
+    """
+    orig = getattr(exc, 'orig', exc)
+    code = getattr(orig, 'sqlite_errorcode', None)
+    if code is not None:
+        return (code & 0xFF) in (SQLITE_BUSY, SQLITE_LOCKED)
+    message = orig.args[0] if getattr(orig, 'args', None) else ''
+    return isinstance(message, str) and message.startswith(('database is locked', 'database table is locked'))
+
+
+def sqlite_retry(max_attempts=5, base_ms=1, cap_ms=100, rollback_session=True):
+    """
+    Retry a DB write when SQLite reports "database is locked"
+    
+    Uses exponential backoff with full jitter: sleep uniform(0, min(cap, base * 2**attempt)).
+    The wrapped function must apply its changes AND commit, so that after a rollback
+    the next attempt re-applies them.
+    
+    Args:
+        max_attempts: Total number of attempts (including the first one)
+        base_ms: Backoff base in milliseconds
+        cap_ms: Maximum backoff in milliseconds
+        rollback_session: Roll back db.session before retrying; pass False when the
+            wrapped function writes through its own connection
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return fn(*args, **kwargs)
+                except OperationalError as e:
+                    if rollback_session:
+                        db.session.rollback()
+                    if not is_sqlite_busy(e) or attempt == max_attempts - 1:
+                        raise
+                    delay_ms = _rng.uniform(0, min(cap_ms, base_ms * 2 ** attempt))
+                    logger.warning(
+                        "Database locked in '%s', retrying in %.1fms (attempt %d/%d)",
+                        fn.__name__, delay_ms, attempt + 1, max_attempts
+                    )
+                    time.sleep(delay_ms / 1000)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def sqlite_write_tx():
+    """
+    Run the block in a single write transaction and commit it on exit
+    
+    On SQLite the transaction is started with BEGIN IMMEDIATE, so the RESERVED lock is
+    taken up front (waiting via busy_timeout) instead of failing on the SHARED -> RESERVED
+    upgrade at commit time. A read-only transaction already open in the session is
+    committed first; loaded objects are then refreshed inside the write transaction.
+    """
+    session = db.session
+    if session.get_bind().dialect.name == 'sqlite':
+        if session.in_transaction():
+            session.commit()
+        session.connection(execution_options={'sqlite_begin_immediate': True})
+    try:
+        yield
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
@@ -2,14 +2,20 @@ from functools import wraps
 from flask import abort
 from flask_login import current_user
 
+STAFF_ROLES = frozenset({'ADMIN', 'MOM', 'OPERATOR'})
+
 def role_required(*roles):
     """Decorator to require specific user roles"""
+    allowed_roles = frozenset(roles)
+    
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if not current_user.is_authenticated:
+            # ✅ Прокси current_user разыменовывается один раз
+            user = current_user._get_current_object()
+            if not user.is_authenticated:
                 return abort(403)
-            if current_user.role not in roles:
+            if user.role not in allowed_roles:
                 return abort(403)
             return f(*args, **kwargs)
         return decorated_function
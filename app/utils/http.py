@@ -0,0 +1,169 @@
+"""
+Shared HTTP client for outgoing API calls (CloudPayments)
+One keep-alive connection pool per process instead of a new TCP/TLS connection per call,
+guarded by a circuit breaker so a failing upstream does not hold request threads
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts used when the caller does not pass one, seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+DEFAULT_POOL_CONNECTIONS = 4   # distinct hosts kept in the pool
+DEFAULT_POOL_MAXSIZE = 16      # keep-alive connections per host (>= concurrent callers)
+
+# Circuit breaker: открывается при доле ошибок >= 50% за 60 с (минимум 10 вызовов)
+CIRCUIT_WINDOW_SECONDS = 60
+CIRCUIT_FAILURE_RATE = 0.5
+CIRCUIT_MIN_CALLS = 10
+CIRCUIT_OPEN_SECONDS = 30      # сколько отклонять вызовы, прежде чем пропустить пробный
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling the upstream while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Failure-rate circuit breaker over a sliding time window
+    
+    Network errors and 5xx responses count as failures. While open, calls fail
+    immediately; after CIRCUIT_OPEN_SECONDS one trial call is let through
+    (half-open) and its outcome closes or re-opens the circuit. before_call returns
+    a token that identifies the trial; calls that started before the circuit opened
+    finish without affecting it.
+    """
+
+    def __init__(self, window=CIRCUIT_WINDOW_SECONDS, failure_rate=CIRCUIT_FAILURE_RATE,
+                 min_calls=CIRCUIT_MIN_CALLS, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.window = window
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self._calls = deque()  # (monotonic time, ok)
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the call must not reach the upstream
+        
+        Returns:
+            True if this call is the half-open trial (pass it to record), False otherwise
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if self._trial_in_flight or time.monotonic() - self._opened_at < self.open_seconds:
+                raise CircuitOpenError('Upstream API circuit is open, call rejected')
+            self._trial_in_flight = True
+            return True
+
+    def record(self, ok, trial=False):
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_at is not None:
+                # ✅ Открытый breaker решает только пробный вызов; запоздавшие вызовы,
+                # ✅ начатые до открытия, его не закрывают и не продлевают
+                if not trial:
+                    return
+                # Результат пробного вызова (half-open)
+                self._trial_in_flight = False
+                if ok:
+                    self._opened_at = None
+                    self._calls.clear()
+                    logger.info('HTTP circuit breaker closed')
+                else:
+                    self._opened_at = now
+                return
+
+            self._calls.append((now, ok))
+            while self._calls and now - self._calls[0][0] > self.window:
+                self._calls.popleft()
+            total = len(self._calls)
+            if total >= self.min_calls:
+                failures = sum(1 for _, call_ok in self._calls if not call_ok)
+                if failures / total >= self.failure_rate:
+                    self._opened_at = now
+                    logger.error(
+                        'HTTP circuit breaker opened: %d of %d calls failed in the last %ds',
+                        failures, total, self.window
+                    )
+
+
+class _TimeoutSession(requests.Session):
+    """requests.Session that applies DEFAULT_TIMEOUT when no timeout is given and goes through the circuit breaker"""
+
+    def __init__(self):
+        super().__init__()
+        self.breaker = CircuitBreaker()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        trial = self.breaker.before_call()
+        started = time.monotonic()
+        try:
+            response = super().request(method, url, **kwargs)
+        except Exception:
+            self.breaker.record(False, trial)
+            logger.warning('%s %s failed after %.1f ms', method, url, (time.monotonic() - started) * 1000)
+            raise
+        self.breaker.record(response.status_code < 500, trial)
+        # ✅ Время вызова (включая handshake, если соединения не было в пуле)
+        logger.debug('%s %s -> %s in %.1f ms', method, url, response.status_code,
+                     (time.monotonic() - started) * 1000)
+        return response
+
+
+def _build_session():
+    pool_connections = DEFAULT_POOL_CONNECTIONS
+    pool_maxsize = DEFAULT_POOL_MAXSIZE
+    if has_app_context():
+        pool_connections = current_app.config.get('HTTP_POOL_CONNECTIONS', pool_connections)
+        pool_maxsize = current_app.config.get('HTTP_POOL_MAXSIZE', pool_maxsize)
+
+    # ✅ Ошибки соединения повторяем всегда (запрос не ушел);
+    # ✅ по статусу повторяем только GET - POST к платежному API не должен уйти дважды
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=0,
+        backoff_factor=0.25,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(['GET'])
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=False,
+        max_retries=retry
+    )
+
+    session = _TimeoutSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    logger.info(f'HTTP client pool initialized: {pool_connections} hosts x {pool_maxsize} connections')
+    return session
+
+
+def cp_session() -> requests.Session:
+    """Get the process-wide HTTP session used for CloudPayments calls"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
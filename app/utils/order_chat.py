@@ -0,0 +1,52 @@
+"""
+System messages in order chats
+Shared by the API handlers and the background notification worker
+"""
+
+from types import MappingProxyType
+from sqlalchemy import select
+from app import db
+from app.models import ChatMessage, OrderChat
+from app.utils.order_status import get_status_label
+
+# System chat messages for order status changes (read-only)
+STATUS_CHANGE_MESSAGES = MappingProxyType({
+    'checkout_initiated': 'Заказ возвращен к оформлению',
+    'awaiting_payment': 'Заказ ожидает оплаты клиентом',
+    'paid': 'Оплата зафиксирована, заказ ждет оператора',
+    'processing': 'Заказ взят в обработку',
+    'awaiting_info': 'Требуется дополнительная информация от клиента',
+    'links_sent': 'Ссылки на видео отправлены клиенту',
+    'completed': 'Заказ завершен',
+    'completed_partial_refund': 'Заказ завершен с частичным возвратом',
+    'refund_required': 'По заказу требуется возврат',
+    'cancelled_unpaid': 'Заказ отменен (не оплачен)',
+    'cancelled_manual': 'Заказ отменен вручную',
+    'refunded_partial': 'Оформлен частичный возврат',
+    'refunded_full': 'Оформлен полный возврат',
+})
+
+
+def stage_status_change_message(order_id, new_status, comment, user_id):
+    """Add the status-change system message (and the chat, if missing) to the session without committing"""
+    message_text = STATUS_CHANGE_MESSAGES.get(new_status, f'Статус изменен на {get_status_label(new_status)}')
+    if comment:
+        message_text += f'. Комментарий: {comment}'
+    
+    # Create or get chat: нужен только id, объект чата не загружаем (flush выдает id нового чата без COMMIT)
+    chat_id = db.session.execute(
+        select(OrderChat.id).where(OrderChat.order_id == order_id).limit(1)
+    ).scalar()
+    if chat_id is None:
+        chat = OrderChat(order_id=order_id)
+        db.session.add(chat)
+        db.session.flush()
+        chat_id = chat.id
+    
+    system_message = ChatMessage(
+        chat_id=chat_id,
+        sender_id=user_id,
+        message=message_text,
+        message_type='system'
+    )
+    db.session.add(system_message)
@@ -119,7 +119,7 @@ def send_order_notification(order, message_text):
     
     try:
         # Find user by email
-        user = User.query.filter_by(email=order.contact_email).first()
+        user = User.query.filter_by(email=order.contact_email.lower()).first()
         if not user or not user.telegram_id:
             # ✅ 152-ФЗ: Не логируем email на уровне INFO
             logger.info(f"User for order {order.id} not found in Telegram or not registered")
@@ -0,0 +1,138 @@
+"""
+Process-level cache of the video type catalog
+VideoType rows are admin-managed and change rarely, so handlers read them from memory
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from app.models import VideoType
+
+logger = logging.getLogger(__name__)
+
+VIDEO_TYPES_CACHE_TTL = 60  # seconds
+
+
+@dataclass(frozen=True)
+class VideoTypeInfo:
+    """Read-only snapshot of a VideoType row (safe to share between requests and threads)"""
+    id: int
+    name: str
+    description: Optional[str]
+    price: float
+    is_active: bool
+
+
+@dataclass(frozen=True)
+class _VideoTypesSnapshot:
+    """One consistent load of the catalog; replaced as a whole, never mutated"""
+    at: float  # monotonic time of the load
+    data: Dict[int, VideoTypeInfo]
+    payloads: Dict[int, dict]
+    by_str_id: Dict[str, VideoTypeInfo]
+    active: List[VideoTypeInfo]
+
+
+_snapshot: Optional[_VideoTypesSnapshot] = None
+# ✅ Поколение кеша: загрузка, начатая до инвалидации, не перезапишет кеш устаревшими данными
+_generation = 0
+
+_DIRTY_KEY = 'video_types_dirty'
+
+
+def _get_snapshot(ttl: int) -> _VideoTypesSnapshot:
+    """Return the cached snapshot, reloading it when older than ttl seconds or invalidated"""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - snapshot.at < ttl:
+        return snapshot
+    
+    generation = _generation
+    data = {
+        vt.id: VideoTypeInfo(
+            id=vt.id,
+            name=vt.name,
+            description=vt.description,
+            price=float(vt.price),
+            is_active=bool(vt.is_active)
+        )
+        for vt in VideoType.query.all()
+    }
+    snapshot = _VideoTypesSnapshot(
+        at=time.monotonic(),
+        data=data,
+        payloads={
+            vt.id: {'id': vt.id, 'name': vt.name, 'description': vt.description, 'price': vt.price}
+            for vt in data.values()
+        },
+        by_str_id={str(vt_id): vt for vt_id, vt in data.items()},
+        active=[vt for vt in data.values() if vt.is_active]
+    )
+    if generation == _generation:
+        _snapshot = snapshot
+    return snapshot
+
+
+def get_video_types_map(ttl: int = VIDEO_TYPES_CACHE_TTL) -> Dict[int, VideoTypeInfo]:
+    """
+    Get all video types as {id: VideoTypeInfo}
+    
+    Reloads from the database when the cache is older than ttl seconds or was invalidated.
+    """
+    return _get_snapshot(ttl).data
+
+
+def get_video_type_payloads(ttl: int = VIDEO_TYPES_CACHE_TTL) -> Dict[int, dict]:
+    """
+    Get JSON-ready video type dicts {id: {'id', 'name', 'description', 'price'}}
+    
+    Built together with the cached catalog; callers must not mutate the returned dicts.
+    """
+    return _get_snapshot(ttl).payloads
+
+
+def get_video_types_dict(ttl: int = VIDEO_TYPES_CACHE_TTL) -> Dict[str, VideoTypeInfo]:
+    """
+    Get all video types as {str(id): VideoTypeInfo}
+    
+    The shape templates expect for video_types_dict (order.video_types holds ids, looked up via |string).
+    """
+    return _get_snapshot(ttl).by_str_id
+
+
+def get_active_video_types(ttl: int = VIDEO_TYPES_CACHE_TTL) -> List[VideoTypeInfo]:
+    """Get the active video types (storefront pricing), in the same order as VideoType.query"""
+    return _get_snapshot(ttl).active
+
+
+def invalidate_video_types_cache():
+    """Drop the cached catalog (next call reloads it)"""
+    global _snapshot, _generation
+    _generation += 1
+    _snapshot = None
+
+
+# ✅ Flush только помечает сессию: кеш сбрасывается после COMMIT, иначе запрос между flush
+# ✅ и commit закешировал бы незакоммиченные (или откаченные) данные на весь TTL.
+# ✅ Другие процессы обновятся по TTL
+@event.listens_for(VideoType, 'after_insert')
+@event.listens_for(VideoType, 'after_update')
+@event.listens_for(VideoType, 'after_delete')
+def _on_video_type_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info[_DIRTY_KEY] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session):
+    if session.info.pop(_DIRTY_KEY, False):
+        invalidate_video_types_cache()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _on_rollback(session):
+    session.info.pop(_DIRTY_KEY, None)
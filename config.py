@@ -83,6 +83,11 @@ class Config:
     CLOUDPAYMENTS_TEST_MODE = os.environ.get('CLOUDPAYMENTS_TEST_MODE', 'False').lower() == 'true'
     CLOUDPAYMENTS_WEBHOOK_URL = os.environ.get('CLOUDPAYMENTS_WEBHOOK_URL') or 'https://mainstreamfs.ru/api/cloudpayments/webhook'
     
+    # Outgoing HTTP pool (app/utils/http.py): hosts kept in the pool / keep-alive connections per host
+    # Size HTTP_POOL_MAXSIZE to the number of threads that call CloudPayments concurrently
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS') or 4)
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE') or 16)
+    
     # Telegram Bot Configuration
     TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
     if not TELEGRAM_BOT_TOKEN and os.environ.get('FLASK_ENV') == 'production':
@@ -96,6 +101,8 @@ class Config:
     
     # Flask-Limiter Configuration
     RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL') or os.environ.get('REDIS_URL') or 'memory://'
+    RATELIMIT_STORAGE_URI = RATELIMIT_STORAGE_URL  # name read by Flask-Limiter 3.x
+    RATELIMIT_STRATEGY = 'fixed-window'  # one counter per key; moving-window needs a sorted set per key in Redis
     
     # Test mode - allows payments without user registration
     TEST_MODE = os.environ.get('TEST_MODE', 'True').lower() == 'true'
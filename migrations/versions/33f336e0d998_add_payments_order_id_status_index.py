@@ -0,0 +1,31 @@
+"""Add payments(order_id, status) index
+
+Revision ID: 33f336e0d998
+Revises: 5575b1348884
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '33f336e0d998'
+down_revision = '5575b1348884'
+branch_labels = None
+depends_on = None
+
+
+def _payments_index_names():
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('payments')}
+
+
+def upgrade():
+    # db.create_all() creates the index on new databases only; existing ones get it here
+    if 'ix_payments_order_id_status' not in _payments_index_names():
+        op.create_index('ix_payments_order_id_status', 'payments', ['order_id', 'status'], unique=False)
+
+
+def downgrade():
+    if 'ix_payments_order_id_status' in _payments_index_names():
+        op.drop_index('ix_payments_order_id_status', table_name='payments')
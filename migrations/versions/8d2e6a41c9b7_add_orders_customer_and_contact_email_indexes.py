@@ -0,0 +1,38 @@
+"""Add orders(customer_id, status, created_at) and orders(contact_email) indexes
+
+Revision ID: 8d2e6a41c9b7
+Revises: 33f336e0d998
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e6a41c9b7'
+down_revision = '33f336e0d998'
+branch_labels = None
+depends_on = None
+
+
+def _orders_index_names():
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('orders')}
+
+
+def upgrade():
+    # db.create_all() creates the indexes on new databases only; existing ones get them here
+    existing = _orders_index_names()
+    if 'ix_orders_customer_status_created' not in existing:
+        op.create_index('ix_orders_customer_status_created', 'orders',
+                        ['customer_id', 'status', 'created_at'], unique=False)
+    if 'ix_orders_contact_email' not in existing:
+        op.create_index('ix_orders_contact_email', 'orders', ['contact_email'], unique=False)
+
+
+def downgrade():
+    existing = _orders_index_names()
+    if 'ix_orders_contact_email' in existing:
+        op.drop_index('ix_orders_contact_email', table_name='orders')
+    if 'ix_orders_customer_status_created' in existing:
+        op.drop_index('ix_orders_customer_status_created', table_name='orders')
@@ -0,0 +1,39 @@
+"""Store user emails lowercase
+
+Revision ID: c4a7e2d95f10
+Revises: 8d2e6a41c9b7
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e2d95f10'
+down_revision = '8d2e6a41c9b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # User now lowercases email on write; bring existing rows in line so the unique index on
+    # users.email serves every lookup. Accounts whose emails differ only in case cannot be
+    # lowercased automatically: which one to keep is a manual decision, so stop and list them.
+    collisions = op.get_bind().execute(sa.text(
+        "SELECT lower(email), group_concat(id) FROM users "
+        "GROUP BY lower(email) HAVING count(*) > 1"
+    )).fetchall()
+    if collisions:
+        groups = '; '.join(f'user ids {ids}' for _, ids in collisions)
+        raise RuntimeError(
+            f'Cannot lowercase users.email: {len(collisions)} group(s) of accounts differ only '
+            f'in email case ({groups}). Merge or rename these accounts, then rerun the upgrade.'
+        )
+
+    op.execute("UPDATE users SET email = lower(email) WHERE email <> lower(email)")
+
+
+def downgrade():
+    # Original casing is not recorded; lowercase emails remain valid
+    pass
@@ -0,0 +1,29 @@
+"""Store order contact emails lowercase
+
+Revision ID: e1b8f3a6c2d4
+Revises: c4a7e2d95f10
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b8f3a6c2d4'
+down_revision = 'c4a7e2d95f10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Order now lowercases contact_email on write, like User.email; existing rows must match
+    # so guest order lookups and order -> user matching by email keep working.
+    op.execute(
+        "UPDATE orders SET contact_email = lower(contact_email) "
+        "WHERE contact_email <> lower(contact_email)"
+    )
+
+
+def downgrade():
+    # Original casing is not recorded; lowercase emails remain valid
+    pass